@@ -1,15 +1,131 @@
-import sqlite3, requests, csv, io, json, os, sys, logging, webbrowser, uuid
+import sqlite3, requests, csv, io, json, os, sys, logging, webbrowser, uuid, base64, queue, atexit, threading, time, hashlib, codecs, random, bisect, cProfile, pstats, marshal, zlib, hmac
 from threading import Timer
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import calendar
 from datetime import datetime
-from flask import Flask, render_template, request, jsonify, make_response
+from email.utils import parsedate_to_datetime
+from itertools import groupby
+from requests.adapters import HTTPAdapter
+from flask import Flask, Response, g, render_template, request, jsonify, make_response
 
 def get_resource_path(relative_path):
     if hasattr(sys, '_MEIPASS'):
         return os.path.join(sys._MEIPASS, relative_path)
     return os.path.join(os.path.abspath("."), relative_path)
 
+def env_number(name, default):
+    """Read a numeric tuning knob from the environment, keeping the default on bad input"""
+    try:
+        return type(default)(os.environ.get(name, default))
+    except ValueError:
+        return default
+
 app = Flask(__name__, template_folder=get_resource_path("templates"))
-GEOTAB_BASE_URL = "https://keyless.geotab.com/api"
+GEOTAB_BASE_URL = os.environ.get("GEOTAB_BASE_URL", "https://keyless.geotab.com/api")
+
+# Cliente Geotab: conexiones keep-alive reutilizadas y timeouts (segundos)
+GEOTAB_POOL_SIZE = env_number("GEOTAB_POOL_SIZE", 32)
+GEOTAB_CONNECT_TIMEOUT = env_number("GEOTAB_CONNECT_TIMEOUT", 5.0)
+GEOTAB_READ_TIMEOUT = env_number("GEOTAB_READ_TIMEOUT", 30.0)
+
+# Límite de llamadas por tenant: token bucket (peticiones/s y ráfaga) compartido por rutas y workers,
+# concurrencia AIMD (sube con éxitos, se reduce a la mitad con 429/5xx) y reintentos con backoff
+GEOTAB_RATE = env_number("GEOTAB_RATE", 20.0)
+GEOTAB_BURST = env_number("GEOTAB_BURST", 20)
+GEOTAB_INITIAL_CONCURRENCY = env_number("GEOTAB_INITIAL_CONCURRENCY", 8)
+GEOTAB_MAX_RETRIES = env_number("GEOTAB_MAX_RETRIES", 3)
+GEOTAB_MAX_RETRY_AFTER = env_number("GEOTAB_MAX_RETRY_AFTER", 60.0)
+
+# SQLite: conexiones reutilizadas y PRAGMAs aplicados una vez por conexión
+DB_POOL_SIZE = env_number("DB_POOL_SIZE", 16)
+DB_BUSY_TIMEOUT_MS = env_number("DB_BUSY_TIMEOUT_MS", 10000)
+DB_CACHE_KIB = env_number("DB_CACHE_KIB", 16384)
+DB_MMAP_BYTES = env_number("DB_MMAP_BYTES", 256 * 1024 * 1024)
+
+# Auditoría: filas de log agrupadas en un commit cada AUDIT_FLUSH_MS o AUDIT_BATCH filas
+AUDIT_QUEUE_MAX = env_number("AUDIT_QUEUE_MAX", 10000)
+AUDIT_FLUSH_MS = env_number("AUDIT_FLUSH_MS", 200)
+AUDIT_BATCH = env_number("AUDIT_BATCH", 500)
+
+# Operaciones masivas: hilos concurrentes contra Geotab y filas por transacción SQLite
+# (más hilos que conexiones del pool solo harían cola)
+BULK_WORKERS = env_number("BULK_WORKERS", 8)
+BULK_MAX_WORKERS = GEOTAB_POOL_SIZE
+DB_WRITE_BATCH = 200
+DB_WRITE_INTERVAL = 1.0
+
+# Trabajos masivos: trabajos terminados que se mantienen en memoria y cadencia de eventos SSE (segundos)
+JOBS_KEPT_IN_MEMORY = 50
+JOB_LEASE_SECONDS = 300
+JOB_MAX_ATTEMPTS = 3
+JOB_EVENTS_INTERVAL = 0.5
+JOB_EVENTS_KEEPALIVE = 15
+
+# Trazas por dispositivo de los trabajos masivos (tabla bulk_spans): trabajos más recientes conservados, 0 = sin trazas
+TRACE_JOBS_KEPT = env_number("TRACE_JOBS_KEPT", 20)
+TRACE_SLOWEST = 20
+TRACE_PHASES = ("queue", "throttle", "upstream", "db", "local")
+
+# Sync incremental: un dispositivo sin cambios solo actualiza last_synced_at si es más antiguo que esto;
+# SQL_IN_CHUNK acota los parámetros de cada consulta IN (...)
+SYNC_TOUCH_SECONDS = env_number("SYNC_TOUCH_SECONDS", 3600)
+SQL_IN_CHUNK = 500
+
+# Sincronización en segundo plano: cada SYNC_SCHED_INTERVAL segundos se re-sincronizan como mucho
+# SYNC_SCHED_BUDGET dispositivos por tenant (0 desactiva); prioridad a faulty y llaves a punto de caducar
+SYNC_SCHED_INTERVAL = env_number("SYNC_SCHED_INTERVAL", 60)
+SYNC_SCHED_BUDGET = env_number("SYNC_SCHED_BUDGET", 30)
+SYNC_SCHED_WORKERS = env_number("SYNC_SCHED_WORKERS", 2)
+SYNC_STALE_SECONDS = env_number("SYNC_STALE_SECONDS", 6 * 3600)
+SYNC_EXPIRY_WINDOW_SECONDS = env_number("SYNC_EXPIRY_WINDOW_SECONDS", 3 * 86400)
+
+# Sincronización completa de todos los tenants con sesión una vez al día a esta hora local (-1 desactiva)
+NIGHTLY_SYNC_HOUR = env_number("NIGHTLY_SYNC_HOUR", -1)
+
+# Plantillas compiladas en memoria (se vacía al llegar al máximo)
+TEMPLATE_CACHE_MAX = 1000
+
+# /import-csv: filas por executemany, bytes leídos para detectar la codificación y filas listadas en el informe
+IMPORT_BATCH_ROWS = 5000
+IMPORT_SNIFF_BYTES = 65536
+IMPORT_REPORT_MAX = 1000
+
+# Renovación: ventana por defecto (días) de GET /keys/expiring y POST /keys/renew
+RENEW_DEFAULT_DAYS = 30
+
+# Límite de llaves virtuales por dispositivo impuesto por Geotab
+MAX_KEYS_PER_DEVICE = 4
+
+# Circuito por dispositivo: un error del propio dispositivo (404, 400...) lo deja fuera de los trabajos
+# masivos durante CIRCUIT_BASE_SECONDS, y la espera se duplica con cada fallo seguido hasta CIRCUIT_MAX_SECONDS
+CIRCUIT_BASE_SECONDS = env_number("CIRCUIT_BASE_SECONDS", 900)
+CIRCUIT_MAX_SECONDS = env_number("CIRCUIT_MAX_SECONDS", 86400)
+
+# GET /vehicles: columnas de ordenación permitidas y tamaño máximo de página
+VEHICLE_FIELDS = ("serial", "desc", "keys", "faulty", "circuit")
+VEHICLE_SORTS = {
+    "serial": "v.serial_number",
+    "desc": "COALESCE(v.description, '')",
+    "faulty": "COALESCE(v.faulty, 0)",
+    "keys": "(SELECT COUNT(*) FROM virtual_keys k2 WHERE k2.serial_number = v.serial_number AND k2.tenant_db = v.tenant_db)",
+}
+VEHICLES_MAX_PAGE = 2000
+
+# GET /vehicles/search: resultados por defecto y máximo
+SEARCH_DEFAULT_LIMIT = 100
+SEARCH_MAX_LIMIT = 1000
+
+# /export-csv: dispositivos por bloque enviado al navegador
+EXPORT_CHUNK_ROWS = 500
+
+# Perfilado bajo demanda: ADMIN_TOKEN (cabecera X-Admin-Token) habilita /profiles y X-Profile: 1;
+# fracción de peticiones perfiladas al azar, duración mínima para guardarlas y perfiles conservados
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+PROFILE_SAMPLE_RATE = env_number("PROFILE_SAMPLE_RATE", 0.0)
+PROFILE_MIN_MS = env_number("PROFILE_MIN_MS", 0.0)
+PROFILE_KEEP = env_number("PROFILE_KEEP", 100)
+PROFILE_TOP_FRAMES = 30
 
 exe_dir = os.path.dirname(sys.executable if hasattr(sys, 'frozen') else os.path.abspath(__file__))
 log_file_path = os.path.join(exe_dir, "fleet_manager.log")
@@ -21,12 +137,357 @@ logging.basicConfig(
     handlers=[logging.FileHandler(log_file_path), logging.StreamHandler()]
 )
 
+# ==================== METRICS ====================
+
+# Límites (segundos) de los histogramas de latencia
+METRIC_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class Metrics:
+    """Thread-safe counters and histograms rendered in the Prometheus text format. An update is one
+    bisect plus a dict increment under a lock, so instrumentation can stay on in production."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta = {}    # name -> (type, help, label names)
+        self._series = {}  # name -> {label values: value | [bucket counts..., count, sum]}
+
+    def counter(self, name, help, labels=()):
+        self._meta[name] = ("counter", help, labels)
+        self._series[name] = {}
+
+    def histogram(self, name, help, labels=()):
+        self._meta[name] = ("histogram", help, labels)
+        self._series[name] = {}
+
+    def inc(self, name, *labels, value=1):
+        # Etiquetas siempre como texto: un código HTTP (int) y "error" conviven en la misma serie
+        labels = tuple(map(str, labels))
+        with self._lock:
+            series = self._series[name]
+            series[labels] = series.get(labels, 0) + value
+
+    def observe(self, name, seconds, *labels):
+        i = bisect.bisect_left(METRIC_BUCKETS, seconds)
+        labels = tuple(map(str, labels))
+        with self._lock:
+            h = self._series[name].get(labels)
+            if h is None:
+                h = self._series[name][labels] = [0] * (len(METRIC_BUCKETS) + 2) + [0.0]
+            h[i] += 1
+            h[-2] += 1
+            h[-1] += seconds
+
+    @staticmethod
+    def _labels(names, values, le=None):
+        pairs = [(n, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")) for n, v in zip(names, values)]
+        if le is not None:
+            pairs.append(("le", le))
+        return "{" + ",".join(f'{n}="{v}"' for n, v in pairs) + "}" if pairs else ""
+
+    def render(self, gauges=()):
+        """Exposition text; gauges = [(name, help, label names, {label values: value})] read at scrape time"""
+        with self._lock:
+            snapshot = {name: {k: (list(v) if isinstance(v, list) else v) for k, v in series.items()}
+                        for name, series in self._series.items()}
+        lines = []
+        for name, (kind, help, names) in self._meta.items():
+            lines += [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+            for values, v in sorted(snapshot[name].items()):
+                if kind == "counter":
+                    lines.append(f"{name}{self._labels(names, values)} {v}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(METRIC_BUCKETS, v):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{self._labels(names, values, f'{bound:g}')} {cumulative}")
+                lines.append(f"{name}_bucket{self._labels(names, values, '+Inf')} {v[-2]}")
+                lines.append(f"{name}_sum{self._labels(names, values)} {v[-1]:.6f}")
+                lines.append(f"{name}_count{self._labels(names, values)} {v[-2]}")
+        for name, help, names, series in gauges:
+            lines += [f"# HELP {name} {help}", f"# TYPE {name} gauge"]
+            lines += [f"{name}{self._labels(names, values)} {v}" for values, v in sorted(series.items())]
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.counter("keyless_http_requests_total", "HTTP requests by route template, method and status", ("route", "method", "status"))
+metrics.histogram("keyless_http_request_duration_seconds", "Time to build the response (streamed bodies excluded)", ("route", "method"))
+metrics.counter("keyless_upstream_responses_total", "Geotab API calls by operation and HTTP status (error = no response)", ("operation", "status"))
+metrics.histogram("keyless_upstream_request_duration_seconds", "Geotab API call latency per attempt, limiter wait excluded", ("operation",))
+metrics.histogram("keyless_sqlite_query_duration_seconds", "SQLite statement execution by statement type (row iteration excluded)", ("statement",))
+metrics.counter("keyless_bulk_items_total", "Bulk job devices finished, by job kind and outcome", ("kind", "status"))
+
+@app.before_request
+def _start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def _record_request_metrics(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        metrics.inc("keyless_http_requests_total", route, request.method, response.status_code)
+        metrics.observe("keyless_http_request_duration_seconds", time.perf_counter() - started, route, request.method)
+    return response
+
+# ==================== PROFILING ====================
+
+def _is_admin():
+    token = request.headers.get('X-Admin-Token', '')
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode())
+
+class ProfiledBody:
+    """Streamed bodies are generated after the view returns: keep profiling while they are iterated"""
+
+    def __init__(self, body, profile, finish):
+        self.body, self.profile, self.finish = body, profile, finish
+
+    def __iter__(self):
+        iterator = iter(self.body)
+        while True:
+            self.profile.enable()
+            try:
+                chunk = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.profile.disable()
+            yield chunk
+
+    def close(self):
+        if hasattr(self.body, "close"):
+            self.body.close()
+        self.finish()
+
+class RequestProfiler:
+    """cProfile around whole requests, on demand (admin header X-Profile: 1) or for a random sample of
+    routes. One request is profiled at a time and the rest run untouched. Profiles are stored with their
+    top frames and the raw pstats data; only the newest `keep` are kept."""
+
+    def __init__(self, sample_rate=PROFILE_SAMPLE_RATE, min_ms=PROFILE_MIN_MS, keep=PROFILE_KEEP):
+        self.sample_rate, self.min_ms, self.keep = sample_rate, min_ms, keep
+        self.routes = set()  # vacío = todas las rutas
+        self._active = threading.Lock()
+
+    def config(self):
+        return {"sample_rate": self.sample_rate, "routes": sorted(self.routes), "min_ms": self.min_ms, "keep": self.keep}
+
+    def configure(self, data):
+        """Change the sampling at runtime; raises ValueError on bad input"""
+        sample_rate = float(data.get("sample_rate", self.sample_rate))
+        min_ms = float(data.get("min_ms", self.min_ms))
+        keep = int(data.get("keep", self.keep))
+        routes = data.get("routes", self.routes)
+        routes = {routes} if isinstance(routes, str) else set(routes)
+        if not 0 <= sample_rate <= 1 or min_ms < 0 or keep < 1:
+            raise ValueError("sample_rate must be between 0 and 1, min_ms >= 0 and keep >= 1")
+        self.sample_rate, self.min_ms, self.keep, self.routes = sample_rate, min_ms, keep, routes
+
+    def start(self):
+        """Profiling state for the current request, or None when it is not profiled"""
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        if request.headers.get('X-Profile') == '1' and _is_admin():
+            trigger = "request"
+        elif (self.sample_rate and (route in self.routes if self.routes else not route.startswith(("/profiles", "/metrics")))
+              and random.random() < self.sample_rate):
+            trigger = "sample"
+        else:
+            return None
+        # Un solo perfil a la vez: acota el coste y evita dos perfiladores activos
+        if not self._active.acquire(blocking=False):
+            return None
+        state = {"profile": cProfile.Profile(), "trigger": trigger, "route": route, "method": request.method,
+                 "path": request.full_path.rstrip('?'), "user": request.cookies.get('user_email'),
+                 "started": time.perf_counter(), "done": False}
+        state["profile"].enable()
+        return state
+
+    def finish(self, state, status):
+        if state["done"]:
+            return
+        state["profile"].disable()
+        state["done"] = True
+        self._active.release()
+        duration_ms = (time.perf_counter() - state["started"]) * 1000
+        if state["trigger"] == "sample" and duration_ms < self.min_ms:
+            return
+        try:
+            self._store(state, status, duration_ms)
+        except Exception:
+            logging.exception("No se pudo guardar el perfil")
+
+    @staticmethod
+    def _top(stats, column):
+        """Heaviest functions by own time (column 2) or including callees (column 3)"""
+        rows = sorted(stats.stats.items(), key=lambda item: item[1][column], reverse=True)[:PROFILE_TOP_FRAMES]
+        return [{"function": pstats.func_std_string(func), "calls": nc, "primitive_calls": cc,
+                 "self_ms": round(tt * 1000, 3), "cumulative_ms": round(ct * 1000, 3)}
+                for func, (cc, nc, tt, ct, _) in rows]
+
+    def _store(self, state, status, duration_ms):
+        stats = pstats.Stats(state["profile"])
+        top = {"self": self._top(stats, 2), "cumulative": self._top(stats, 3)}
+        with db_pool.connection() as conn:
+            conn.execute("""INSERT INTO profiles (created_at, route, method, path, status, duration_ms, trigger, user,
+                            total_calls, top_frames, stats) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                         (datetime.now().isoformat(), state["route"], state["method"], state["path"], status,
+                          round(duration_ms, 3), state["trigger"], state["user"], stats.total_calls,
+                          json.dumps(top), zlib.compress(marshal.dumps(stats.stats))))
+            conn.execute("DELETE FROM profiles WHERE id <= (SELECT id FROM profiles ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                         (self.keep,))
+            conn.commit()
+
+profiler = RequestProfiler()
+
+@app.before_request
+def _start_profile():
+    state = profiler.start()
+    if state:
+        g.profile = state
+
+@app.after_request
+def _finish_profile(response):
+    state = g.pop('profile', None)
+    # Un flujo SSE puede durar horas: solo se perfila la vista, no el cuerpo, para no retener el perfilador
+    if state and response.is_streamed and response.mimetype != 'text/event-stream':
+        state["profile"].disable()
+        response.response = ProfiledBody(response.response, state["profile"],
+                                         lambda status=response.status_code: profiler.finish(state, status))
+    elif state:
+        profiler.finish(state, response.status_code)
+    return response
+
+@app.teardown_request
+def _abort_profile(exc):
+    # Excepción no controlada: after_request no se ejecutó
+    state = g.pop('profile', None)
+    if state:
+        profiler.finish(state, 500)
+
+# ==================== SQLITE CONNECTIONS ====================
+
+SQL_STATEMENTS = {"SELECT", "INSERT", "UPDATE", "DELETE", "WITH", "PRAGMA", "BEGIN", "COMMIT", "CREATE", "ALTER", "DROP"}
+
+def _observe_query(sql, started):
+    elapsed = time.perf_counter() - started
+    statement = sql.lstrip()[:7].split(None, 1)
+    statement = statement[0].upper() if statement else ""
+    metrics.observe("keyless_sqlite_query_duration_seconds", elapsed, statement if statement in SQL_STATEMENTS else "OTHER")
+    _trace_add("db", elapsed)
+
+class TimedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            _observe_query(sql, started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            _observe_query(sql, started)
+
+class TimedConnection(sqlite3.Connection):
+    """sqlite3 connection whose statements and commits feed keyless_sqlite_query_duration_seconds"""
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        started = time.perf_counter()
+        try:
+            super().commit()
+        finally:
+            _observe_query("COMMIT", started)
+
+class ConnectionPool:
+    """Reusable SQLite connections opened in WAL mode with tuned pragmas"""
+
+    def __init__(self, size=DB_POOL_SIZE):
+        self._idle = queue.LifoQueue(maxsize=size)
+
+    def _connect(self):
+        conn = sqlite3.connect(db_path, timeout=DB_BUSY_TIMEOUT_MS / 1000, check_same_thread=False, factory=TimedConnection)
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")  # seguro en WAL, evita un fsync por commit
+        conn.execute(f"PRAGMA cache_size = -{DB_CACHE_KIB}")
+        conn.execute(f"PRAGMA mmap_size = {DB_MMAP_BYTES}")
+        conn.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        # INSERT OR REPLACE dispara los triggers de borrado (índice de búsqueda)
+        conn.execute("PRAGMA recursive_triggers = ON")
+        return conn
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self._connect()
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection outside of a request (worker threads, streamed responses)"""
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close_all(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+db_pool = ConnectionPool()
+atexit.register(db_pool.close_all)
+
+def get_db():
+    """Connection for the current request, returned to the pool on teardown"""
+    if 'db' not in g:
+        g.db = db_pool.acquire()
+    return g.db
+
+@app.teardown_appcontext
+def release_db(exc):
+    conn = g.pop('db', None)
+    if conn is not None:
+        db_pool.release(conn)
+
 def init_db():
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
-    # Crear tablas si no existen
+    with db_pool.connection() as conn:
+        _init_schema(conn)
+
+def _add_missing_columns(c, table, columns):
+    """ALTER TABLE for every (name, type) not present yet; only used by the baseline migration"""
+    existing = [info[1] for info in c.execute(f"PRAGMA table_info({table})").fetchall()]
+    for name, ddl in columns:
+        if existing and name not in existing:
+            logging.info(f"Migrando base de datos: Añadiendo columna {name} a {table}...")
+            c.execute(f"ALTER TABLE {table} ADD COLUMN {name} {ddl}")
+
+def _migration_1_base(c):
+    """Tables as of the first versioned schema; databases created before it get their missing columns"""
     c.execute('''CREATE TABLE IF NOT EXISTS vehicles
-                 (serial_number TEXT, description TEXT, tenant_db TEXT, faulty INTEGER DEFAULT 0, PRIMARY KEY(serial_number, tenant_db))''')
+                 (serial_number TEXT, description TEXT, tenant_db TEXT, faulty INTEGER DEFAULT 0,
+                  keys_hash TEXT, last_synced_at TEXT, PRIMARY KEY(serial_number, tenant_db))''')
     c.execute('''CREATE TABLE IF NOT EXISTS virtual_keys
                  (vk_id TEXT PRIMARY KEY, serial_number TEXT, tenant_db TEXT, user_ref TEXT, expires_at INTEGER)''')
     c.execute('''CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)''')
@@ -37,65 +498,557 @@ def init_db():
                   user_ref TEXT, vk_config TEXT NOT NULL, nfc_tags TEXT NOT NULL, duration_months INTEGER DEFAULT 12,
                   version INTEGER DEFAULT 1, previous_version_id TEXT, is_active INTEGER DEFAULT 1,
                   created_at TEXT NOT NULL, created_by TEXT, UNIQUE(tenant_db, name, version))''')
-    
-    # MIGRACIÓN: Verificar si falta la columna tenant_db en la tabla vehicles (para dbs antiguas)
-    c.execute("PRAGMA table_info(vehicles)")
-    columns = [info[1] for info in c.fetchall()]
-    if 'tenant_db' not in columns:
-        logging.info("Migrando base de datos: Añadiendo columna tenant_db...")
-        try:
-            c.execute("ALTER TABLE vehicles ADD COLUMN tenant_db TEXT DEFAULT 'default'")
-        except Exception as e:
-            logging.error(f"Error en migración: {e}")
-
-    # MIGRACIÓN: Añadir columna expires_at a virtual_keys
-    c.execute("PRAGMA table_info(virtual_keys)")
-    vk_columns = [info[1] for info in c.fetchall()]
-    if 'expires_at' not in vk_columns:
-        logging.info("Migrando base de datos: Añadiendo columna expires_at...")
-        try:
-            c.execute("ALTER TABLE virtual_keys ADD COLUMN expires_at INTEGER")
-        except Exception as e:
-            logging.error(f"Error en migración expires_at: {e}")
-
-    # MIGRACIÓN: Añadir columna faulty a vehicles
-    c.execute("PRAGMA table_info(vehicles)")
-    v_columns = [info[1] for info in c.fetchall()]
-    if 'faulty' not in v_columns:
-        logging.info("Migrando base de datos: Añadiendo columna faulty...")
-        try:
-            c.execute("ALTER TABLE vehicles ADD COLUMN faulty INTEGER DEFAULT 0")
-        except Exception as e:
-            logging.error(f"Error en migración faulty: {e}")
-
-    # MIGRACIÓN: Añadir columna user_ref a vk_templates
-    c.execute("PRAGMA table_info(vk_templates)")
-    tpl_columns = [info[1] for info in c.fetchall()]
-    if tpl_columns and 'user_ref' not in tpl_columns:
-        logging.info("Migrando base de datos: Añadiendo columna user_ref a vk_templates...")
+    c.execute('''CREATE TABLE IF NOT EXISTS bulk_jobs
+                 (id TEXT PRIMARY KEY, kind TEXT NOT NULL, tenant_db TEXT, created_by TEXT, status TEXT NOT NULL,
+                  total INTEGER NOT NULL, done INTEGER DEFAULT 0, failed INTEGER DEFAULT 0, params TEXT,
+                  created_at TEXT NOT NULL, finished_at TEXT, idempotency_key TEXT)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS bulk_job_items
+                 (job_id TEXT NOT NULL, serial TEXT NOT NULL, status TEXT NOT NULL DEFAULT 'pending',
+                  result TEXT, finished_at TEXT, attempts INTEGER NOT NULL DEFAULT 0, lease_owner TEXT,
+                  lease_until REAL, idempotency_key TEXT, PRIMARY KEY(job_id, serial))''')
+
+    # Bases de datos anteriores a las migraciones versionadas
+    _add_missing_columns(c, "vehicles", [("tenant_db", "TEXT DEFAULT 'default'"), ("faulty", "INTEGER DEFAULT 0"),
+                                         ("keys_hash", "TEXT"), ("last_synced_at", "TEXT")])
+    _add_missing_columns(c, "virtual_keys", [("expires_at", "INTEGER")])
+    _add_missing_columns(c, "vk_templates", [("user_ref", "TEXT")])
+    _add_missing_columns(c, "bulk_jobs", [("idempotency_key", "TEXT")])
+    _add_missing_columns(c, "bulk_job_items", [("attempts", "INTEGER NOT NULL DEFAULT 0"), ("lease_owner", "TEXT"),
+                                               ("lease_until", "REAL"), ("idempotency_key", "TEXT")])
+
+def _migration_2_indexes(c):
+    """Secondary indexes for the per-device, per-tenant and audit log lookups"""
+    c.execute("CREATE INDEX IF NOT EXISTS idx_virtual_keys_device ON virtual_keys (serial_number, tenant_db)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_virtual_keys_expiry ON virtual_keys (tenant_db, expires_at)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_vehicles_last_synced ON vehicles (tenant_db, last_synced_at)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_logs_action ON logs (action, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_logs_serial ON logs (serial, id)")
+    # (tenant_db, name) ya está cubierto por UNIQUE(tenant_db, name, version); este sirve al listado de activas
+    c.execute("CREATE INDEX IF NOT EXISTS idx_vk_templates_active ON vk_templates (tenant_db, is_active, name)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_bulk_jobs_tenant ON bulk_jobs (tenant_db, status, created_at)")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_bulk_jobs_idempotency ON bulk_jobs (idempotency_key)")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_bulk_job_items_idempotency ON bulk_job_items (idempotency_key)")
+    c.execute("ANALYZE")
+
+def _migration_3_search(c):
+    """FTS5 index over serial, description and key user references (rowid = vehicles.rowid), kept by triggers"""
+    c.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS vehicle_search USING fts5(
+                 serial, description, user_refs, tenant_db UNINDEXED,
+                 tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')""")
+    refs = """(SELECT group_concat(user_ref, ' ') FROM virtual_keys k
+               WHERE k.serial_number = {0}.serial_number AND k.tenant_db = {0}.tenant_db)"""
+    c.execute(f"""CREATE TRIGGER IF NOT EXISTS vehicles_search_insert AFTER INSERT ON vehicles BEGIN
+                  INSERT INTO vehicle_search (rowid, serial, description, user_refs, tenant_db)
+                  VALUES (new.rowid, new.serial_number, new.description, {refs.format('new')}, new.tenant_db);
+                  END""")
+    c.execute("""CREATE TRIGGER IF NOT EXISTS vehicles_search_delete AFTER DELETE ON vehicles BEGIN
+                 DELETE FROM vehicle_search WHERE rowid = old.rowid;
+                 END""")
+    # Solo columnas indexadas: las escrituras de sync (faulty, keys_hash, last_synced_at) no tocan el índice
+    c.execute(f"""CREATE TRIGGER IF NOT EXISTS vehicles_search_update
+                  AFTER UPDATE OF serial_number, description, tenant_db ON vehicles BEGIN
+                  UPDATE vehicle_search SET serial = new.serial_number, description = new.description,
+                         user_refs = {refs.format('new')}, tenant_db = new.tenant_db WHERE rowid = old.rowid;
+                  END""")
+    for event, row in (("INSERT", "new"), ("DELETE", "old"), ("UPDATE OF user_ref, serial_number, tenant_db", "new")):
+        name = event.split()[0].lower()
+        c.execute(f"""CREATE TRIGGER IF NOT EXISTS virtual_keys_search_{name} AFTER {event} ON virtual_keys BEGIN
+                      UPDATE vehicle_search SET user_refs = {refs.format(row)}
+                      WHERE rowid = (SELECT rowid FROM vehicles v
+                                     WHERE v.serial_number = {row}.serial_number AND v.tenant_db = {row}.tenant_db);
+                      END""")
+    c.execute(f"""INSERT INTO vehicle_search (rowid, serial, description, user_refs, tenant_db)
+                  SELECT v.rowid, v.serial_number, v.description, {refs.format('v')}, v.tenant_db FROM vehicles v""")
+
+def _migration_4_key_template(c):
+    """Template each key was issued from, so renewals can re-issue it with the same configuration"""
+    c.execute("ALTER TABLE virtual_keys ADD COLUMN template_id TEXT")
+
+def _migration_5_circuit(c):
+    """Per-device circuit breaker: consecutive failures, last error and when the device may be retried"""
+    for column in ("fail_count INTEGER DEFAULT 0", "last_error TEXT", "last_error_status INTEGER", "retry_at TEXT"):
+        c.execute(f"ALTER TABLE vehicles ADD COLUMN {column}")
+    c.execute("UPDATE vehicles SET fail_count = 1 WHERE faulty = 1")
+
+def _migration_6_profiles(c):
+    """Request profiles: top frames as JSON and the zlib-compressed pstats data"""
+    c.execute('''CREATE TABLE profiles (id INTEGER PRIMARY KEY AUTOINCREMENT, created_at TEXT, route TEXT, method TEXT,
+                 path TEXT, status INTEGER, duration_ms REAL, trigger TEXT, user TEXT, total_calls INTEGER,
+                 top_frames TEXT, stats BLOB)''')
+    c.execute("CREATE INDEX idx_profiles_route ON profiles(route, created_at)")
+    c.execute("CREATE INDEX idx_profiles_created ON profiles(created_at)")
+
+def _migration_7_bulk_spans(c):
+    """Per-device timing of bulk jobs, one row per attempt (milliseconds per phase)"""
+    c.execute('''CREATE TABLE bulk_spans (job_id TEXT, serial TEXT, attempt INTEGER, started_at REAL, queue_ms REAL,
+                 throttle_ms REAL, upstream_ms REAL, db_ms REAL, local_ms REAL, status TEXT, http_status INTEGER,
+                 retries INTEGER)''')
+    c.execute("CREATE INDEX idx_bulk_spans_job ON bulk_spans(job_id)")
+
+def _migration_8_circuit_device_errors(c):
+    """Only 404/410 open the circuit now: close the ones opened by request rejections (400, 409, 422...)"""
+    c.execute(f"UPDATE vehicles SET {CIRCUIT_RESET} WHERE faulty = 1 AND last_error_status NOT IN (404, 410)")
+
+def _migration_9_drop_item_idempotency(c):
+    """bulk_job_items.idempotency_key only repeated (job_id, serial), which is already the primary key"""
+    c.execute("DROP INDEX IF EXISTS idx_bulk_job_items_idempotency")
+    columns = [info[1] for info in c.execute("PRAGMA table_info(bulk_job_items)").fetchall()]
+    # DROP COLUMN necesita SQLite 3.35; en versiones anteriores la columna queda sin usar
+    if "idempotency_key" in columns and sqlite3.sqlite_version_info >= (3, 35, 0):
+        c.execute("ALTER TABLE bulk_job_items DROP COLUMN idempotency_key")
+
+# Migración N lleva la base de datos de user_version N-1 a N; solo se añaden al final
+SCHEMA_MIGRATIONS = [_migration_1_base, _migration_2_indexes, _migration_3_search, _migration_4_key_template,
+                     _migration_5_circuit, _migration_6_profiles, _migration_7_bulk_spans,
+                     _migration_8_circuit_device_errors, _migration_9_drop_item_idempotency]
+
+def _init_schema(conn):
+    c = conn.cursor()
+    version = c.execute("PRAGMA user_version").fetchone()[0]
+    for target in range(version + 1, len(SCHEMA_MIGRATIONS) + 1):
+        logging.info(f"Migrando base de datos a la versión {target}...")
+        conn.commit()
+        c.execute("BEGIN IMMEDIATE")
         try:
-            c.execute("ALTER TABLE vk_templates ADD COLUMN user_ref TEXT")
-        except Exception as e:
-            logging.error(f"Error en migración user_ref: {e}")
+            SCHEMA_MIGRATIONS[target - 1](c)
+            c.execute(f"PRAGMA user_version = {target}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            logging.exception(f"Error en la migración {target}")
+            raise
+
+    # Trabajos que seguían en curso cuando se cerró el proceso: quedan a la espera de reanudación
+    restart_interrupted.update(r[0] for r in c.execute("SELECT id FROM bulk_jobs WHERE status = 'running'"))
+    c.execute("UPDATE bulk_jobs SET status = 'interrupted' WHERE status = 'running'")
+    c.execute("UPDATE bulk_job_items SET status = 'pending', lease_owner = NULL, lease_until = NULL WHERE status = 'leased'")
+    if c.rowcount:
+        logging.info(f"{c.rowcount} elementos de trabajos interrumpidos vuelven a la cola")
 
     conn.commit()
-    conn.close()
     logging.info("Base de datos lista.")
 
+# ==================== GEOTAB CLIENT ====================
+
+def _retry_after_seconds(res):
+    """Retry-After as seconds (delta or HTTP date), capped; None when absent or unparseable"""
+    value = res.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    return min(max(seconds, 0.0), GEOTAB_MAX_RETRY_AFTER)
+
+def is_device_error(status):
+    """Upstream statuses that say the device itself is unusable (unknown or removed). Rejections of the
+    request (400/409/422: payload, key limit) are only recorded on the job item and never open the circuit."""
+    return status in (404, 410)
+
+class TenantLimiter:
+    """Token bucket plus AIMD concurrency limit for one tenant, shared by every route and worker thread"""
+
+    def __init__(self, rate=GEOTAB_RATE, burst=GEOTAB_BURST,
+                 concurrency=GEOTAB_INITIAL_CONCURRENCY, max_concurrency=GEOTAB_POOL_SIZE):
+        self.max_rate, self.rate, self.burst = rate, rate, burst
+        self.tokens = float(burst)
+        self.max_limit = max_concurrency
+        self.limit = float(min(concurrency, max_concurrency))
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.requests = self.throttled = self.errors = self.retries = 0
+        self._refilled_at = time.monotonic()
+        self._decreased_at = 0.0
+        self._cond = threading.Condition()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+
+    def acquire(self, retry=False):
+        """Block until the tenant has a free concurrency slot, a token and no active Retry-After pause.
+        Every acquire() must be paired with exactly one release()."""
+        with self._cond:
+            if retry:
+                self.retries += 1
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self.paused_until:
+                    timeout = self.paused_until - now
+                elif self.in_flight >= int(self.limit):
+                    timeout = None  # release() avisa
+                elif self.tokens < 1:
+                    timeout = (1 - self.tokens) / self.rate
+                else:
+                    self.tokens -= 1
+                    self.in_flight += 1
+                    self.requests += 1
+                    return
+                self._cond.wait(timeout)
+
+    def release(self, outcome, retry_after=None):
+        """outcome: "ok", "throttled" (429) or "error" (5xx / network)"""
+        with self._cond:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if outcome == "ok":
+                # Aumento aditivo: +1 de concurrencia por cada ventana completa de éxitos
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 100)
+            else:
+                if outcome == "throttled":
+                    self.throttled += 1
+                    self.paused_until = max(self.paused_until, now + (retry_after if retry_after is not None else 1.0))
+                else:
+                    self.errors += 1
+                # Reducción multiplicativa, como mucho una vez por segundo: una ráfaga de 429 simultáneos cuenta una vez
+                if now - self._decreased_at >= 1.0:
+                    self._decreased_at = now
+                    self.limit = max(1.0, self.limit / 2)
+                    if outcome == "throttled":
+                        self.rate = max(self.max_rate / 20, self.rate / 2)
+            self._cond.notify_all()
+
+    def snapshot(self):
+        with self._cond:
+            return {"concurrency_limit": int(self.limit), "in_flight": self.in_flight, "rate": round(self.rate, 2),
+                    "paused_for": round(max(self.paused_until - time.monotonic(), 0), 2), "requests": self.requests,
+                    "throttled": self.throttled, "errors": self.errors, "retries": self.retries}
+
+class GeotabClient:
+    """Keyless API client. Each tenant gets its own pooled keep-alive session and limiter, shared by
+    its routes and worker threads, so one tenant's bulk job cannot use up another tenant's connections."""
+
+    def __init__(self, base_url, pool_size=GEOTAB_POOL_SIZE,
+                 connect_timeout=GEOTAB_CONNECT_TIMEOUT, read_timeout=GEOTAB_READ_TIMEOUT):
+        self.base_url = base_url
+        self.timeout = (connect_timeout, read_timeout)
+        self.pool_size = pool_size
+        self.session = self._new_session()
+        self._sessions = {}
+        self._limiters = {}
+        self._limiters_lock = threading.Lock()
+
+    def _new_session(self):
+        session = requests.Session()
+        # pool_block: los hilos esperan una conexión libre en vez de abrir conexiones sueltas
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, pool_block=True)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.headers["Connection"] = "keep-alive"
+        return session
+
+    def limiter(self, tenant):
+        with self._limiters_lock:
+            if tenant not in self._limiters:
+                self._limiters[tenant] = TenantLimiter()
+            return self._limiters[tenant]
+
+    def _session_for(self, tenant):
+        if tenant is None:
+            return self.session  # /auth
+        with self._limiters_lock:
+            if tenant not in self._sessions:
+                self._sessions[tenant] = self._new_session()
+            return self._sessions[tenant]
+
+    def limiter_stats(self):
+        with self._limiters_lock:
+            limiters = dict(self._limiters)
+        return {tenant or "auth": lim.snapshot() for tenant, lim in limiters.items()}
+
+    def _request(self, operation, method, path, token=None, tenant=None, **kwargs):
+        """Rate-limited request; 429 and 5xx are retried with Retry-After or backoff, res.retries says how often.
+        Every attempt is recorded under `operation` in the upstream metrics."""
+        headers = kwargs.pop("headers", {})
+        if token:
+            headers["Authorization"] = f"Bearer {token}"
+        limiter, session = self.limiter(tenant), self._session_for(tenant)
+        for attempt in range(GEOTAB_MAX_RETRIES + 1):
+            if attempt:
+                _trace_add("retries", 1)
+            waited = time.perf_counter()
+            limiter.acquire(retry=attempt > 0)
+            outcome, retry_after, failure = "error", None, None
+            try:
+                started = time.perf_counter()
+                _trace_add("throttle", started - waited)
+                try:
+                    res = session.request(method, f"{self.base_url}{path}", headers=headers,
+                                          timeout=self.timeout, **kwargs)
+                except requests.RequestException as e:
+                    metrics.inc("keyless_upstream_responses_total", operation, "error")
+                    # Solo se repiten fallos de red; un POST que pudo llegar a Geotab no (crearía la llave dos veces)
+                    if (attempt == GEOTAB_MAX_RETRIES or not isinstance(e, (requests.ConnectionError, requests.Timeout))
+                            or (method == "POST" and not isinstance(e, requests.ConnectTimeout))):
+                        raise
+                    failure = e
+                finally:
+                    _trace_add("upstream", time.perf_counter() - started)
+                    metrics.observe("keyless_upstream_request_duration_seconds", time.perf_counter() - started, operation)
+                if failure is None:
+                    metrics.inc("keyless_upstream_responses_total", operation, res.status_code)
+                    if res.status_code == 429:
+                        outcome, retry_after = "throttled", _retry_after_seconds(res)
+                    elif res.status_code < 500:
+                        outcome = "ok"
+            finally:
+                # Pase lo que pase (incluso en los hooks de métricas/traza) el hueco se devuelve una sola vez
+                limiter.release(outcome, retry_after)
+            if failure is not None:
+                self._pause(self._backoff(attempt))
+                continue
+
+            status = res.status_code
+            # 429/503: la petición no se procesó; 502/504 solo se repiten si es idempotente
+            retryable = status in (429, 503) or (status in (502, 504) and method != "POST")
+            if not retryable or attempt == GEOTAB_MAX_RETRIES:
+                res.retries = attempt
+                return res
+            if status == 429:
+                # La pausa del limitador aplica Retry-After a todo el tenant; el suelo exponencial evita que
+                # los reintentos lleguen en bloque cuando Retry-After es 0 o falta
+                self._pause(max(retry_after or 0.0, self._backoff(attempt, floor=True)))
+            else:
+                delay = _retry_after_seconds(res) if status == 503 else None
+                self._pause(delay if delay is not None else self._backoff(attempt))
+
+    @staticmethod
+    def _pause(seconds):
+        """Wait before a retry; counted as throttling in the bulk trace"""
+        time.sleep(seconds)
+        _trace_add("throttle", seconds)
+
+    @staticmethod
+    def _backoff(attempt, floor=False):
+        """Exponential backoff with full jitter: 0.5 s, 1 s, 2 s... capped at 10 s.
+        With floor=True the whole step is waited and only up to 0.5 s of jitter is added."""
+        step = min(10.0, 0.5 * 2 ** attempt)
+        return step + random.uniform(0, 0.5) if floor else random.uniform(0, step)
+
+    def authenticate(self, credentials):
+        return self._request("auth", "POST", "/auth", json=credentials)
+
+    def list_virtual_keys(self, token, tenant, serial):
+        return self._request("list_keys", "GET", f"/tenants/{tenant}/devices/{serial}/virtual-keys",
+                             token, tenant, params={"virtualKeysFilter": "Stored"})
+
+    def create_virtual_key(self, token, tenant, serial, payload):
+        return self._request("create_key", "POST", f"/tenants/{tenant}/devices/{serial}/virtual-keys", token, tenant, json=payload)
+
+    def delete_virtual_key(self, token, tenant, serial, vk_id):
+        return self._request("delete_key", "DELETE", f"/tenants/{tenant}/devices/{serial}/virtual-keys/{vk_id}", token, tenant)
+
+geotab = GeotabClient(GEOTAB_BASE_URL)
+
+@app.errorhandler(requests.RequestException)
+def upstream_unavailable(e):
+    logging.error(f"Geotab API no disponible: {e}")
+    return jsonify({"error": "Geotab API unavailable", "details": str(e)[:200]}), 502
+
+@app.route('/upstream-limits', methods=['GET'])
+def upstream_limits():
+    """Per-tenant limiter state: current concurrency, token rate, Retry-After pause and 429/5xx counts"""
+    return jsonify(geotab.limiter_stats())
+
+# ==================== SESSIONS ====================
+
+class TokenStore:
+    """Server-side Geotab sessions keyed by tenant, so routes, bulk jobs and the background sync can work
+    on several databases at once. Credentials are kept in memory only, to log in again after a 401.
+    A tenant's session can only be used by the browsers that logged in to it (their session_id cookie)."""
+
+    def __init__(self):
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._login_lock = threading.Lock()
+
+    def put(self, tenant, token, user, credentials=None, owner=None):
+        with self._lock:
+            # Los navegadores que ya habían iniciado sesión en el tenant siguen siendo dueños
+            owners = self._sessions[tenant]["owners"] if tenant in self._sessions else set()
+            if owner:
+                owners.add(owner)
+            self._sessions[tenant] = {"token": token, "user": user, "credentials": credentials,
+                                      "since": datetime.now().isoformat(), "owners": owners}
+
+    def owns(self, tenant, owner):
+        """True when the browser with session id `owner` logged in to the tenant"""
+        with self._lock:
+            s = self._sessions.get(tenant)
+            return bool(owner and s and owner in s["owners"])
+
+    def leave(self, tenant, owner):
+        """Logout of one browser; the session is dropped when no browser uses it any more"""
+        with self._lock:
+            s = self._sessions.get(tenant)
+            if s and owner in s["owners"]:
+                s["owners"].discard(owner)
+                if not s["owners"]:
+                    del self._sessions[tenant]
+
+    def get(self, tenant):
+        """(token, user) of the tenant, or (None, None) when nobody is logged in to it"""
+        with self._lock:
+            s = self._sessions.get(tenant)
+            return (s["token"], s["user"]) if s else (None, None)
+
+    def remove(self, tenant):
+        with self._lock:
+            self._sessions.pop(tenant, None)
+
+    def items(self):
+        """{tenant: (token, user)} snapshot"""
+        with self._lock:
+            return {t: (s["token"], s["user"]) for t, s in self._sessions.items()}
+
+    def describe(self, owner):
+        """Sessions of the tenants the browser `owner` logged in to"""
+        with self._lock:
+            return [{"tenant": t, "user": s["user"], "since": s["since"], "can_refresh": bool(s["credentials"])}
+                    for t, s in sorted(self._sessions.items()) if owner and owner in s["owners"]]
+
+    def refresh(self, tenant, expired_token):
+        """Log in again with the stored credentials after expired_token got a 401. Returns the new token,
+        or None (session dropped). Threads that hit the same expired token share one login."""
+        with self._login_lock:
+            with self._lock:
+                s = self._sessions.get(tenant)
+                if not s or s["token"] != expired_token:
+                    return s and s["token"]
+                credentials = s["credentials"]
+            res = geotab.authenticate(credentials) if credentials else None
+            if res is None or res.status_code != 200:
+                logging.info(f"Sesión de {tenant} caducada y sin renovar")
+                self.remove(tenant)
+                return None
+            with self._lock:
+                s["token"] = res.json().get("accessToken")
+                return s["token"]
+
+token_store = TokenStore()
+
+def _owns(tenant):
+    return token_store.owns(tenant, request.cookies.get('session_id'))
+
+def _session(tenant=None):
+    """(token, tenant) for a request: ?tenant= selects another tenant this browser logged in to, otherwise
+    the tenant cookie. A login from before a restart still works through the access_token cookie."""
+    tenant = tenant or request.args.get('tenant') or request.cookies.get('tenant')
+    if _owns(tenant):
+        return token_store.get(tenant)[0], tenant
+    if tenant == request.cookies.get('tenant'):
+        # Sin sesión en el servidor solo vale el token propio del navegador; Geotab lo valida contra el tenant
+        return request.cookies.get('access_token'), tenant
+    return None, tenant
+
+@app.route('/sessions', methods=['GET'])
+def list_sessions():
+    """Tenants this browser has a server-side session for (tokens are never returned)"""
+    return jsonify(token_store.describe(request.cookies.get('session_id')))
+
+# ==================== AUDIT LOG ====================
+
+class AuditWriter:
+    """Background thread that group-commits audit rows into the logs table"""
+
+    def __init__(self, max_queue=AUDIT_QUEUE_MAX, flush_ms=AUDIT_FLUSH_MS, batch=AUDIT_BATCH):
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._interval = flush_ms / 1000
+        self._batch = batch
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopping = False
+        self.submitted = 0
+        self.written = 0
+        self.backpressure_events = 0
+
+    def start(self):
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="audit-writer", daemon=True)
+                self._thread.start()
+
+    def submit(self, row):
+        """Queue a row; when the queue is full the caller writes it synchronously and False is returned"""
+        if self._thread is None:
+            self.start()
+        with self._cond:
+            self.submitted += 1
+        try:
+            self._queue.put_nowait(row)
+            return True
+        except queue.Full:
+            self.backpressure_events += 1
+            if self.backpressure_events % 100 == 1:
+                logging.warning(f"Cola de auditoría llena ({self._queue.maxsize}): escritura síncrona "
+                                f"({self.backpressure_events} eventos)")
+            self._write([row])
+            return False
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def flush(self, timeout=5.0):
+        """Wait until every row submitted so far is committed"""
+        with self._cond:
+            target = self.submitted
+            return self._cond.wait_for(lambda: self.written >= target, timeout)
+
+    def stop(self, timeout=10.0):
+        self._stopping = True
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while not (self._stopping and self._queue.empty()):
+            try:
+                batch = [self._queue.get(timeout=self._interval)]
+            except queue.Empty:
+                continue
+            deadline = time.monotonic() + self._interval
+            while len(batch) < self._batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._write(batch)
+
+    def _write(self, rows):
+        for attempt in range(3):
+            try:
+                with db_pool.connection() as conn:
+                    conn.executemany("INSERT INTO logs (timestamp, user, action, serial, parameters) VALUES (?, ?, ?, ?, ?)", rows)
+                    conn.commit()
+                break
+            except sqlite3.Error as e:
+                logging.error(f"Error escribiendo {len(rows)} filas de auditoría (intento {attempt + 1}): {e}")
+                time.sleep(0.5 * (attempt + 1))
+        with self._cond:
+            self.written += len(rows)
+            self._cond.notify_all()
+
+audit_writer = AuditWriter()
+atexit.register(audit_writer.stop)
+
 def add_log(user, action, serial, params):
     ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    conn = sqlite3.connect(db_path)
-    conn.execute("INSERT INTO logs (timestamp, user, action, serial, parameters) VALUES (?, ?, ?, ?, ?)",
-                 (ts, user, action, serial, json.dumps(params)))
-    conn.commit()
-    conn.close()
+    audit_writer.submit((ts, user, action, serial, json.dumps(params)))
 
 @app.route('/')
 def index(): return render_template('index.html')
 
 @app.route('/settings', methods=['GET', 'POST'])
 def manage_settings():
-    conn = sqlite3.connect(db_path)
+    conn = get_db()
     if request.method == 'POST':
         for k, v in request.json.items():
             conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (k, v))
@@ -104,78 +1057,341 @@ def manage_settings():
     cur = conn.cursor()
     cur.execute("SELECT * FROM settings")
     settings = {r[0]: r[1] for r in cur.fetchall()}
-    conn.close()
     return jsonify(settings)
 
 @app.route('/auth', methods=['POST'])
 def authenticate():
-    res = requests.post(f"{GEOTAB_BASE_URL}/auth", json=request.json)
+    res = geotab.authenticate(request.json)
     if res.status_code == 200:
         resp = make_response(jsonify({"status": "success"}))
-        resp.set_cookie('access_token', res.json().get("accessToken"), httponly=True)
-        resp.set_cookie('tenant', request.json['database'])
+        # Un mismo navegador conserva su session_id al entrar en varios tenants
+        session_id = request.cookies.get('session_id') or uuid.uuid4().hex
+        # SameSite=Lax: otro sitio no puede lanzar POST (cancelar, reanudar, sync...) con estas cookies
+        resp.set_cookie('session_id', session_id, httponly=True, samesite='Lax')
+        resp.set_cookie('access_token', res.json().get("accessToken"), httponly=True, samesite='Lax')
+        resp.set_cookie('tenant', request.json['database'], samesite='Lax')
         logging.info(f"Login OK: {request.json['username']} -> {request.json['database']}")
+        # Los trabajos propios cortados por un reinicio continúan con el nuevo token
+        resume_interrupted_jobs(request.json['database'], res.json().get("accessToken"), request.json['username'])
+        token_store.put(request.json['database'], res.json().get("accessToken"), request.json['username'],
+                        dict(request.json), owner=session_id)
         add_log(request.json['username'], "LOGIN", request.json['database'], {"status": "success"})
         return resp
     add_log(request.json.get('username', 'unknown'), "LOGIN_FAILED", request.json.get('database', 'unknown'), {"status": res.status_code})
     return jsonify({"error": "Auth failed"}), 401
 
+def _encode_cursor(sort_value, serial):
+    return base64.urlsafe_b64encode(json.dumps([sort_value, serial]).encode()).decode()
+
+def _decode_cursor(cursor):
+    sort_value, serial = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    return sort_value, serial
+
+def _query_vehicles(cur, tenant, fields, sort="serial", descending=False, after=None, limit=None, rowids=None):
+    """One joined query for a page of vehicles and their keys. Returns (vehicles, sort values)."""
+    sort_expr = VEHICLE_SORTS[sort]
+    direction, op = ("DESC", "<") if descending else ("ASC", ">")
+    where, params = "v.tenant_db = ?", [tenant]
+    if rowids is not None:
+        where += f" AND v.rowid IN ({','.join('?' * len(rowids))})"
+        params += list(rowids)
+    if after is not None:
+        where += f" AND ({sort_expr}, v.serial_number) {op} (?, ?)"
+        params += list(after)
+    page_sql = f"""SELECT v.serial_number, v.description, v.faulty, v.fail_count, v.last_error, v.last_error_status,
+                          v.retry_at, {sort_expr} AS sort_key FROM vehicles v
+                   WHERE {where} ORDER BY sort_key {direction}, v.serial_number {direction}"""
+    if limit is not None:
+        page_sql += " LIMIT ?"
+        params.append(limit)
+
+    with_keys = "keys" in fields
+    if with_keys:
+        cur.execute(f"""SELECT p.serial_number, p.description, p.faulty, p.fail_count, p.last_error, p.last_error_status,
+                               p.retry_at, p.sort_key, k.vk_id, k.user_ref, k.expires_at
+                        FROM ({page_sql}) p
+                        LEFT JOIN virtual_keys k ON k.serial_number = p.serial_number AND k.tenant_db = ?
+                        ORDER BY p.sort_key {direction}, p.serial_number {direction}, k.rowid""", params + [tenant])
+    else:
+        cur.execute(page_sql, params)
+
+    vehicles, sort_values, current, now = [], [], None, datetime.now().isoformat()
+    for r in cur:
+        if current is None or current["serial"] != r[0]:
+            current = {"serial": r[0], "desc": r[1], "faulty": bool(r[2]), "circuit": _circuit(r[2], *r[3:7], now)}
+            if with_keys:
+                current["keys"] = []
+            vehicles.append(current)
+            sort_values.append(r[7])
+        if with_keys and r[8] is not None:
+            current["keys"].append({"id": r[8], "ref": r[9], "expires": r[10]})
+    return vehicles, sort_values
+
 @app.route('/vehicles', methods=['GET', 'POST'])
 def manage_vehicles():
+    """List vehicles with their keys. Passing limit= returns {"items", "next_cursor"} pages
+    (cursor=, sort=serial|desc|faulty|keys, order=asc|desc, fields=serial,desc,keys,faulty);
+    without it the whole fleet is returned as a plain list."""
     tenant = request.args.get('tenant')
     if not tenant: return jsonify([])
-    conn = sqlite3.connect(db_path)
+    conn = get_db()
     if request.method == 'POST':
         v = request.json
         conn.execute("INSERT OR REPLACE INTO vehicles (serial_number, description, tenant_db) VALUES (?, ?, ?)",
                      (v['serial'].strip(), v['desc'].strip(), tenant))
         conn.commit()
         add_log(request.cookies.get('user_email'), "ADD_DEVICE", v['serial'].strip(), {"desc": v['desc'].strip()})
-    
+
+    sort = request.args.get('sort', 'serial')
+    fields = [f for f in request.args.get('fields', ",".join(VEHICLE_FIELDS)).split(',') if f in VEHICLE_FIELDS]
+    if sort not in VEHICLE_SORTS or not fields:
+        return jsonify({"error": f"sort must be one of {list(VEHICLE_SORTS)}, fields a subset of {list(VEHICLE_FIELDS)}"}), 400
+    descending = request.args.get('order', 'asc') == 'desc'
     cur = conn.cursor()
-    cur.execute("SELECT serial_number, description, faulty FROM vehicles WHERE tenant_db = ?", (tenant,))
-    v_rows = cur.fetchall()
-    vehicles = []
-    for vr in v_rows:
-        cur.execute("SELECT vk_id, user_ref, expires_at FROM virtual_keys WHERE serial_number = ? AND tenant_db = ?", (vr[0], tenant))
-        keys = [{"id": kr[0], "ref": kr[1], "expires": kr[2]} for kr in cur.fetchall()]
-        vehicles.append({"serial": vr[0], "desc": vr[1], "keys": keys, "faulty": bool(vr[2])})
-    conn.close()
-    return jsonify(vehicles)
+
+    if request.method == 'POST' or 'limit' not in request.args:
+        vehicles, _ = _query_vehicles(cur, tenant, fields, sort, descending)
+        return jsonify([{f: v[f] for f in fields} for v in vehicles])
+
+    try:
+        limit = max(1, min(int(request.args['limit']), VEHICLES_MAX_PAGE))
+        after = _decode_cursor(request.args['cursor']) if request.args.get('cursor') else None
+    except (ValueError, TypeError):
+        return jsonify({"error": "Invalid limit or cursor"}), 400
+
+    # Se pide una fila extra para saber si hay página siguiente
+    vehicles, sort_values = _query_vehicles(cur, tenant, fields, sort, descending, after, limit + 1)
+    next_cursor = None
+    if len(vehicles) > limit:
+        vehicles = vehicles[:limit]
+        next_cursor = _encode_cursor(sort_values[limit - 1], vehicles[-1]["serial"])
+    return jsonify({"items": [{f: v[f] for f in fields} for v in vehicles], "next_cursor": next_cursor})
+
+def _search_query(text):
+    """Every whitespace-separated term becomes a quoted FTS5 prefix query (terms are ANDed)"""
+    return " ".join('"' + term.replace('"', '""') + '"*' for term in text.split())
+
+@app.route('/vehicles/search', methods=['GET'])
+def search_vehicles():
+    """Prefix search over serials, descriptions and key user references: ?q=&limit= (results sorted by serial)"""
+    tenant = request.args.get('tenant') or request.cookies.get('tenant')
+    query = _search_query(request.args.get('q', ''))
+    if not tenant or not query: return jsonify({"items": [], "truncated": False})
+    try:
+        limit = max(1, min(int(request.args.get('limit', SEARCH_DEFAULT_LIMIT)), SEARCH_MAX_LIMIT))
+    except ValueError:
+        return jsonify({"error": "Invalid limit"}), 400
+    fields = [f for f in request.args.get('fields', ",".join(VEHICLE_FIELDS)).split(',') if f in VEHICLE_FIELDS] or list(VEHICLE_FIELDS)
+
+    cur = get_db().cursor()
+    # Sin ORDER BY rank: con prefijos cortos ordenar todas las coincidencias costaría más que la propia búsqueda
+    rowids = [r[0] for r in cur.execute("SELECT rowid FROM vehicle_search WHERE vehicle_search MATCH ? AND tenant_db = ? LIMIT ?",
+                                        (query, tenant, limit + 1))]
+    truncated = len(rowids) > limit
+    vehicles, _ = _query_vehicles(cur, tenant, fields, rowids=rowids[:limit]) if rowids else ([], [])
+    return jsonify({"items": [{f: v[f] for f in fields} for v in vehicles], "truncated": truncated})
+
+def _keys_hash(virtual_keys):
+    """Order-independent fingerprint of a device's upstream key list"""
+    rows = sorted((vk['virtualKeyId'], vk.get('userReference'), vk.get('endingTimestamp')) for vk in virtual_keys)
+    return hashlib.sha1(json.dumps(rows).encode()).hexdigest()
+
+def _chunks(items, size=SQL_IN_CHUNK):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def _store_synced_keys(conn, tenant, synced):
+    """Apply upstream key lists ({serial: virtualKeys}) as a diff against local rows (no commit).
+    Devices whose key hash did not change are only read; last_synced_at is refreshed for them
+    at most every SYNC_TOUCH_SECONDS. Returns the serials whose keys actually changed."""
+    now = datetime.now()
+    known = {}
+    for part in _chunks(list(synced)):
+        known.update((r[0], r[1:]) for r in conn.execute(
+            f"""SELECT serial_number, keys_hash, faulty, last_synced_at FROM vehicles
+                WHERE tenant_db = ? AND serial_number IN ({','.join('?' * len(part))})""", [tenant, *part]))
+
+    hashes = {serial: _keys_hash(vks) for serial, vks in synced.items()}
+    changed = [s for s in synced if s not in known or known[s][0] != hashes[s]]
+    # Sin cambios: solo se reescribe si estaba marcado como faulty o la fecha de sync es antigua
+    cutoff = datetime.fromtimestamp(now.timestamp() - SYNC_TOUCH_SECONDS).isoformat()
+    touch = [s for s in synced if s in known and known[s][0] == hashes[s] and
+             (known[s][1] or not known[s][2] or known[s][2] < cutoff)]
+
+    if changed:
+        local = {}
+        for part in _chunks(changed):
+            for vk_id, serial, ref, expires in conn.execute(
+                    f"""SELECT vk_id, serial_number, user_ref, expires_at FROM virtual_keys
+                        WHERE tenant_db = ? AND serial_number IN ({','.join('?' * len(part))})""", [tenant, *part]):
+                local[vk_id] = (serial, ref, expires)
+        upstream = {vk['virtualKeyId']: (serial, vk.get('userReference'), vk.get('endingTimestamp'))
+                    for serial in changed for vk in synced[serial]}
+        conn.executemany("DELETE FROM virtual_keys WHERE vk_id = ?", [(k,) for k in local.keys() - upstream.keys()])
+        # Upsert: template_id (solo conocido localmente) se conserva
+        conn.executemany("""INSERT INTO virtual_keys (vk_id, serial_number, tenant_db, user_ref, expires_at) VALUES (?, ?, ?, ?, ?)
+                            ON CONFLICT(vk_id) DO UPDATE SET serial_number = excluded.serial_number, tenant_db = excluded.tenant_db,
+                            user_ref = excluded.user_ref, expires_at = excluded.expires_at""",
+                         [(k, v[0], tenant, v[1], v[2]) for k, v in upstream.items() if local.get(k) != v])
+
+    conn.executemany(f"UPDATE vehicles SET keys_hash = ?, {CIRCUIT_RESET}, last_synced_at = ? WHERE serial_number = ? AND tenant_db = ?",
+                     [(hashes[s], now.isoformat(), s, tenant) for s in changed + touch])
+    return changed
+
+# Un éxito cierra el circuito del dispositivo
+CIRCUIT_RESET = "faulty = 0, fail_count = 0, last_error = NULL, last_error_status = NULL, retry_at = NULL"
+
+def _circuit(faulty, fail_count, last_error, last_error_status, retry_at, now):
+    """Breaker state of a device row: None while closed; open until retry_at, then half-open
+    (the next call is the probe that closes or re-opens it)"""
+    if not faulty:
+        return None
+    return {"state": "open" if retry_at and retry_at > now else "half_open", "failures": fail_count or 1,
+            "error": last_error, "http_status": last_error_status, "retry_at": retry_at}
+
+def _mark_faulty(conn, tenant, failures):
+    """Open the circuit of devices whose call failed with a device error, failures = [(serial, http_status)].
+    The retry delay doubles with every consecutive failure (no commit)"""
+    failures = dict(failures)
+    counts = {}
+    for part in _chunks(list(failures)):
+        counts.update(conn.execute(f"""SELECT serial_number, fail_count FROM vehicles
+                                       WHERE tenant_db = ? AND serial_number IN ({','.join('?' * len(part))})""", [tenant, *part]))
+    now, rows = time.time(), []
+    for serial, count in counts.items():
+        count = (count or 0) + 1
+        delay = min(CIRCUIT_MAX_SECONDS, CIRCUIT_BASE_SECONDS * 2 ** min(count - 1, 30))
+        status = failures[serial]
+        # Solo los errores del dispositivo (is_device_error) abren el circuito: siempre "not_found"
+        rows.append((count, "not_found", status, datetime.fromtimestamp(now + delay).isoformat(), serial, tenant))
+    conn.executemany("""UPDATE vehicles SET faulty = 1, fail_count = ?, last_error = ?, last_error_status = ?, retry_at = ?
+                        WHERE serial_number = ? AND tenant_db = ?""", rows)
+
+def _close_circuits(conn, tenant, serials):
+    """A successful call proves the device exists: close its circuit (no commit)"""
+    conn.executemany(f"UPDATE vehicles SET {CIRCUIT_RESET} WHERE serial_number = ? AND tenant_db = ? AND faulty = 1",
+                     [(s, tenant) for s in serials])
+
+def _circuit_filter(conn, tenant, serials, include_open=False):
+    """Order a bulk run: healthy devices first, then half-open ones. Open circuits are skipped, or run
+    last with include_open. Returns (serials, skipped outcomes for start_bulk_job's `resolved`)."""
+    faulty = {}
+    for part in _chunks(serials):
+        faulty.update((r[0], r) for r in conn.execute(
+            f"""SELECT serial_number, fail_count, last_error, last_error_status, retry_at FROM vehicles
+                WHERE tenant_db = ? AND faulty = 1 AND serial_number IN ({','.join('?' * len(part))})""", [tenant, *part]))
+    now = datetime.now().isoformat()
+    open_ = {s for s, r in faulty.items() if r[4] and r[4] > now}
+    ordered = ([s for s in serials if s not in faulty] + [s for s in serials if s in faulty and s not in open_]
+               + [s for s in serials if s in open_])
+    if include_open:
+        return ordered, []
+    skipped = [{"serial": s, "status": "skipped", "circuit": "open",
+                "error": f"Circuit open after {r[1] or 1} failures ({r[2]} {r[3]}), next retry {r[4][:16]}"}
+               for s, r in faulty.items() if s in open_]
+    return ordered, skipped
+
+def _invalidate_keys_hash(conn, tenant, serials):
+    """Local key writes make the stored hash stale; the next sync re-diffs those devices (no commit)"""
+    conn.executemany("UPDATE vehicles SET keys_hash = NULL WHERE serial_number = ? AND tenant_db = ?",
+                     [(s, tenant) for s in serials])
 
 @app.route('/sync-key/<serial>', methods=['GET'])
 def sync_key(serial):
-    token, tenant = request.cookies.get('access_token'), request.cookies.get('tenant')
+    token, tenant = _session()
     if not token: return jsonify({"error": "No session"}), 401
-    res = requests.get(f"{GEOTAB_BASE_URL}/tenants/{tenant}/devices/{serial}/virtual-keys?virtualKeysFilter=Stored",
-                        headers={"Authorization": f"Bearer {token}"})
+    res = geotab.list_virtual_keys(token, tenant, serial)
     if res.status_code == 200:
-        conn = sqlite3.connect(db_path)
-        conn.execute("DELETE FROM virtual_keys WHERE serial_number = ? AND tenant_db = ?", (serial, tenant))
-        keys_synced = 0
-        for vk in res.json().get('virtualKeys', []):
-            expires_at = vk.get('endingTimestamp')
-            conn.execute("INSERT INTO virtual_keys (vk_id, serial_number, tenant_db, user_ref, expires_at) VALUES (?, ?, ?, ?, ?)",
-                         (vk['virtualKeyId'], serial, tenant, vk.get('userReference'), expires_at))
-            keys_synced += 1
-        # Clear faulty status on successful sync
-        conn.execute("UPDATE vehicles SET faulty = 0 WHERE serial_number = ? AND tenant_db = ?", (serial, tenant))
+        conn = get_db()
+        virtual_keys = res.json().get('virtualKeys', [])
+        changed = _store_synced_keys(conn, tenant, {serial: virtual_keys})
         conn.commit()
-        conn.close()
-        add_log(request.cookies.get('user_email'), "SYNC", serial, {"keys_found": keys_synced})
+        add_log(request.cookies.get('user_email'), "SYNC", serial, {"keys_found": len(virtual_keys), "changed": bool(changed)})
         return jsonify(res.json())
     else:
-        # Mark device as faulty
-        conn = sqlite3.connect(db_path)
-        conn.execute("UPDATE vehicles SET faulty = 1 WHERE serial_number = ? AND tenant_db = ?", (serial, tenant))
-        conn.commit()
-        conn.close()
+        # Solo errores del dispositivo lo marcan como faulty; 429/5xx son del servicio
+        conn = get_db()
+        if is_device_error(res.status_code):
+            _mark_faulty(conn, tenant, [(serial, res.status_code)])
+            conn.commit()
         add_log(request.cookies.get('user_email'), "SYNC_ERROR", serial, {"status": res.status_code, "error": res.text[:200]})
         return jsonify({"error": "Sync failed", "details": res.text}), res.status_code
 
+def _sync_handlers(tenant, token, user, params):
+    def work(serial, attempt):
+        res = geotab.list_virtual_keys(token, tenant, serial)
+        if res.status_code == 200:
+            return {"serial": serial, "status": "ok", "keys": res.json().get('virtualKeys', [])}
+        return {"serial": serial, "status": "error", "http_status": res.status_code, "error": res.text[:200]}
+
+    def apply(conn, batch):
+        synced = {o["serial"]: o.pop("keys") for o in batch if o["status"] == "ok"}
+        changed = set(_store_synced_keys(conn, tenant, synced))
+        for o in batch:
+            if o["serial"] in synced:
+                o["keys_found"], o["changed"] = len(synced[o["serial"]]), o["serial"] in changed
+        _mark_faulty(conn, tenant, [(o["serial"], o["http_status"]) for o in batch if is_device_error(o.get("http_status", 0))])
+
+    def on_finish(job):
+        add_log(user, "BULK_SYNC", f"{job.total} devices",
+                {"synced": job.done, "errors": job.failed, "skipped": params.get("skipped", 0), "job_id": job.id})
+
+    return work, apply, on_finish
+
+@app.route('/sync-bulk', methods=['POST'])
+def sync_bulk():
+    """Sync many devices as a background job: {"serials": [...]} or {"all": true} for the whole tenant"""
+    token, tenant = _session()
+    if not token: return jsonify({"error": "No session"}), 401
+    data = request.json or {}
+
+    if data.get('all'):
+        serials = [r[0] for r in get_db().execute("SELECT serial_number FROM vehicles WHERE tenant_db = ?", (tenant,))]
+    else:
+        serials = _requested_serials(data)
+    if not serials: return jsonify({"error": "No devices selected"}), 400
+
+    job = _start_sync_job(get_db(), tenant, token, request.cookies.get('user_email'), serials, data)
+    return _job_response(job, data)
+
+def _start_sync_job(conn, tenant, token, user, serials, data):
+    # El sync nunca omite dispositivos con el circuito abierto (es lo que corrige la lista local): solo van al final
+    serials, _ = _circuit_filter(conn, tenant, serials, include_open=True)
+    return start_bulk_job("sync", tenant, token, user, serials, {}, data)
+
+def sync_tenants(tenants, data):
+    """Start a full sync job for every tenant at once; each runs on its own workers, connections and
+    rate budget, so the whole refresh takes as long as the largest tenant. Returns {tenant: job}."""
+    sessions, jobs = token_store.items(), {}
+    with db_pool.connection() as conn:
+        for tenant in tenants:
+            token, user = sessions.get(tenant, (None, None))
+            serials = [r[0] for r in conn.execute("SELECT serial_number FROM vehicles WHERE tenant_db = ?", (tenant,))]
+            if token and serials:
+                key = data.get('idempotency_key')
+                jobs[tenant] = _start_sync_job(conn, tenant, token, user, serials,
+                                               {**data, "idempotency_key": key and f"{key}:{tenant}"})
+    return jobs
+
+@app.route('/sync-tenants', methods=['POST'])
+def sync_tenants_route():
+    """Full sync of several tenants in parallel: {"tenants": [...]} (default: every tenant with a session)"""
+    data = request.json or {}
+    tenants = data.get('tenants') or [t["tenant"] for t in token_store.describe(request.cookies.get('session_id'))]
+    missing = [t for t in tenants if not _owns(t)]
+    if missing: return jsonify({"error": "No session", "tenants": missing}), 401
+    jobs = sync_tenants(tenants, data)
+    if not data.get('wait'):
+        return jsonify({"jobs": {t: {"job_id": j.id, "total": j.total} for t, j in jobs.items()}}), 202
+    for job in jobs.values():
+        version = None
+        while job.status == "running":
+            version, _ = job.wait(version, JOB_EVENTS_KEEPALIVE)
+    return jsonify({"jobs": {t: j.snapshot() for t, j in jobs.items()}})
+
 @app.route('/create-key', methods=['POST'])
 def create_key():
-    token, tenant = request.cookies.get('access_token'), request.cookies.get('tenant')
+    token, tenant = _session()
     if not token: return jsonify({"error": "No session"}), 401
     payload = request.json
     serial = payload.pop('serialNumber')
@@ -185,18 +1401,11 @@ def create_key():
     template_name = payload.pop('_template_name', None)
     template_version = payload.pop('_template_version', None)
 
-    res = requests.post(f"{GEOTAB_BASE_URL}/tenants/{tenant}/devices/{serial}/virtual-keys",
-                        json=payload, headers={"Authorization": f"Bearer {token}", "Content-Type": "application/json"})
+    res = geotab.create_virtual_key(token, tenant, serial, payload)
     if res.status_code == 200:
-        vk = res.json()
-        conn = sqlite3.connect(db_path)
-        expires_at = vk.get('endingTimestamp')
-        conn.execute("INSERT INTO virtual_keys (vk_id, serial_number, tenant_db, user_ref, expires_at) VALUES (?, ?, ?, ?, ?)",
-                     (vk['virtualKeyId'], serial, tenant, vk.get('userReference'), expires_at))
-        # Clear faulty status on successful create
-        conn.execute("UPDATE vehicles SET faulty = 0 WHERE serial_number = ? AND tenant_db = ?", (serial, tenant))
+        conn = get_db()
+        _store_created_key(conn, serial, tenant, res.json(), template_id)
         conn.commit()
-        conn.close()
 
         # Enhanced logging with template info
         log_params = {"userRef": payload.get('userReference')}
@@ -206,44 +1415,207 @@ def create_key():
             log_params["template_version"] = template_version
         add_log(request.cookies.get('user_email'), "CREATE_VK", serial, log_params)
     else:
-        # Mark device as faulty on 404 (device not found) or other errors
-        conn = sqlite3.connect(db_path)
-        conn.execute("UPDATE vehicles SET faulty = 1 WHERE serial_number = ? AND tenant_db = ?", (serial, tenant))
-        conn.commit()
-        conn.close()
+        # Mark device as faulty on 404 (device not found) or other device errors, not on throttling/outages
+        if is_device_error(res.status_code):
+            conn = get_db()
+            _mark_faulty(conn, tenant, [(serial, res.status_code)])
+            conn.commit()
         add_log(request.cookies.get('user_email'), "CREATE_VK_ERROR", serial, {"status": res.status_code, "error": res.text[:200]})
     return jsonify(res.json()), res.status_code
 
+def _add_months(dt, months):
+    month = dt.month - 1 + months
+    year, month = dt.year + month // 12, month % 12 + 1
+    return dt.replace(year=year, month=month, day=min(dt.day, calendar.monthrange(year, month)[1]))
+
+def _template_payload(tpl, user_ref=None, months=None, now=None):
+    """Build the Geotab VK body for a template row (same shape the UI builds in updateVkBody)"""
+    now = now or datetime.now()
+    end = _add_months(now, months or tpl["duration_months"] or 12)
+    return {
+        **tpl["body"],
+        "userReference": user_ref or tpl["body"]["userReference"],
+        "beginningTimestamp": int(now.timestamp() * 1000),
+        "endingTimestamp": int(end.timestamp() * 1000),
+    }
+
+def _compile_template(row):
+    """Parse and validate a vk_templates row once; body is the Geotab payload minus the timestamps"""
+    tpl = {"id": row[0], "tenant_db": row[1], "name": row[2], "user_ref": row[3],
+           "vk_config": json.loads(row[4]), "nfc_tags": json.loads(row[5]), "duration_months": row[6],
+           "version": row[7], "previous_version_id": row[8], "is_active": bool(row[9]),
+           "created_at": row[10], "created_by": row[11]}
+    if not isinstance(tpl["vk_config"], dict) or not isinstance(tpl["nfc_tags"], list):
+        raise ValueError(f"Template {tpl['id']} has an invalid vk_config or nfc_tags")
+    if not isinstance(tpl["duration_months"] or 12, int) or (tpl["duration_months"] or 12) < 1:
+        raise ValueError(f"Template {tpl['id']} has an invalid duration")
+    tpl["body"] = {
+        "isStoredVirtualKey": True,
+        "tapCardSerialNumbers": tpl["nfc_tags"],
+        "userReference": tpl["user_ref"] or "Master Key",
+        **{k: v for k, v in tpl["vk_config"].items() if k not in ("beginningTimestamp", "endingTimestamp")},
+    }
+    return tpl
+
+class TemplateCache:
+    """Compiled templates keyed by (tenant_db, template_id, version). Template rows are immutable apart from
+    is_active (PUT creates a new id), so entries only need dropping when manage_template changes a row."""
+
+    def __init__(self, max_entries=TEMPLATE_CACHE_MAX):
+        self._entries = {}
+        self._versions = {}
+        self._lock = threading.Lock()
+        self._max = max_entries
+        self.hits = self.misses = 0
+
+    def get(self, conn, tenant, template_id):
+        with self._lock:
+            version = self._versions.get((tenant, template_id))
+            tpl = self._entries.get((tenant, template_id, version))
+            if tpl is not None:
+                self.hits += 1
+                return tpl
+            self.misses += 1
+        row = conn.execute("""SELECT id, tenant_db, name, user_ref, vk_config, nfc_tags, duration_months, version,
+                              previous_version_id, is_active, created_at, created_by
+                              FROM vk_templates WHERE id = ? AND tenant_db = ?""", (template_id, tenant)).fetchone()
+        if not row:
+            return None
+        tpl = _compile_template(row)
+        with self._lock:
+            if len(self._entries) >= self._max:
+                self._entries.clear()
+                self._versions.clear()
+            self._entries[(tenant, template_id, tpl["version"])] = tpl
+            self._versions[(tenant, template_id)] = tpl["version"]
+        return tpl
+
+    def invalidate(self, tenant, template_id):
+        with self._lock:
+            version = self._versions.pop((tenant, template_id), None)
+            self._entries.pop((tenant, template_id, version), None)
+
+template_cache = TemplateCache()
+
+def _load_template(conn, tenant, template_id):
+    return template_cache.get(conn, tenant, template_id)
+
+def _store_created_key(conn, serial, tenant, vk, template_id=None):
+    conn.execute("INSERT OR REPLACE INTO virtual_keys (vk_id, serial_number, tenant_db, user_ref, expires_at, template_id) VALUES (?, ?, ?, ?, ?, ?)",
+                 (vk['virtualKeyId'], serial, tenant, vk.get('userReference'), vk.get('endingTimestamp'), template_id))
+    # Clear faulty status on successful create; the next sync re-diffs this device
+    conn.execute(f"UPDATE vehicles SET {CIRCUIT_RESET}, keys_hash = NULL WHERE serial_number = ? AND tenant_db = ?", (serial, tenant))
+
+def _devices_at_key_limit(conn, tenant):
+    return {r[0] for r in conn.execute("""SELECT serial_number FROM virtual_keys WHERE tenant_db = ?
+                                          GROUP BY serial_number HAVING COUNT(*) >= ?""", (tenant, MAX_KEYS_PER_DEVICE))}
+
+def _create_handlers(tenant, token, user, params):
+    payload, template_info = params["payload"], params.get("template_info", {})
+
+    def work(serial, attempt):
+        if attempt > 1:
+            # Reintento tras una caída: si la llave ya existe en Geotab no se vuelve a crear
+            res = geotab.list_virtual_keys(token, tenant, serial)
+            if res.status_code == 200:
+                for vk in res.json().get('virtualKeys', []):
+                    if (vk.get('userReference') == payload.get('userReference')
+                            and vk.get('endingTimestamp') == payload.get('endingTimestamp')):
+                        return {"serial": serial, "status": "ok", "vk": vk, "recovered": True}
+        res = geotab.create_virtual_key(token, tenant, serial, payload)
+        if res.status_code == 200:
+            return {"serial": serial, "status": "ok", "vk": res.json()}
+        return {"serial": serial, "status": "error", "http_status": res.status_code, "error": res.text[:200]}
+
+    def apply(conn, batch):
+        for o in batch:
+            if o["status"] == "ok":
+                vk = o.pop("vk")
+                _store_created_key(conn, o["serial"], tenant, vk, template_info.get("template_id"))
+                o["vk_id"] = vk['virtualKeyId']
+                add_log(user, "CREATE_VK", o["serial"], {"userRef": payload.get('userReference'), **template_info})
+            else:
+                add_log(user, "CREATE_VK_ERROR", o["serial"], {"status": o.get("http_status"), "error": o["error"]})
+        _mark_faulty(conn, tenant, [(o["serial"], o["http_status"]) for o in batch if is_device_error(o.get("http_status", 0))])
+
+    def on_finish(job):
+        add_log(user, "BULK_CREATE_VK", f"{job.total} devices",
+                {"created": job.done, "errors": job.failed, "skipped": params.get("skipped", 0), "job_id": job.id, **template_info})
+
+    return work, apply, on_finish
+
+@app.route('/create-keys-bulk', methods=['POST'])
+def create_keys_bulk():
+    """Deploy one key to many devices as a background job.
+    Body: {"serials": [...], "vk": {...}} or {"serials": [...], "template_id": ..., "user_ref"?, "duration_months"?}"""
+    token, tenant = _session()
+    if not token: return jsonify({"error": "No session"}), 401
+    data = request.json or {}
+    serials = _requested_serials(data)
+    if not serials: return jsonify({"error": "No devices selected"}), 400
+
+    conn = get_db()
+    if data.get('template_id'):
+        try:
+            tpl = _load_template(conn, tenant, data['template_id'])
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 422
+        if not tpl: return jsonify({"error": "Template not found"}), 404
+        # Plantilla compilada una vez para todo el trabajo; cada dispositivo recibe el mismo payload
+        payload = _template_payload(tpl, data.get('user_ref'), data.get('duration_months'))
+        template_info = {"template_id": tpl["id"], "template_name": tpl["name"], "template_version": tpl["version"]}
+    elif isinstance(data.get('vk'), dict):
+        payload = {k: v for k, v in data['vk'].items() if k != 'serialNumber' and not k.startswith('_')}
+        template_info = {k: data['vk'].get(f"_{k}") for k in ("template_id", "template_name", "template_version")}
+        template_info = template_info if template_info["template_id"] else {}
+    else:
+        return jsonify({"error": "Provide vk or template_id"}), 400
+
+    # Límite de 4 llaves comprobado en servidor con una sola consulta agrupada
+    at_limit = _devices_at_key_limit(conn, tenant)
+    skipped = [{"serial": s, "status": "skipped", "error": f"Device already has {MAX_KEYS_PER_DEVICE} keys"}
+               for s in serials if s in at_limit]
+    serials, open_skipped = _circuit_filter(conn, tenant, serials, data.get('include_open'))
+    skipped += [o for o in open_skipped if o["serial"] not in at_limit]
+
+    params = {"payload": payload, "template_info": template_info, "skipped": len(skipped)}
+    job = start_bulk_job("create", tenant, token, request.cookies.get('user_email'), serials, params, data, resolved=skipped)
+    return _job_response(job, data)
+
 @app.route('/delete-key/<serial>/<vk_id>', methods=['DELETE'])
 def delete_key(serial, vk_id):
     """Delete a single virtual key from a device"""
-    token, tenant = request.cookies.get('access_token'), request.cookies.get('tenant')
+    token, tenant = _session()
     if not token: return jsonify({"error": "No session"}), 401
 
     # Delete from Geotab API
-    res = requests.delete(f"{GEOTAB_BASE_URL}/tenants/{tenant}/devices/{serial}/virtual-keys/{vk_id}",
-                          headers={"Authorization": f"Bearer {token}"})
+    res = geotab.delete_virtual_key(token, tenant, serial, vk_id)
 
     if res.status_code in [200, 202, 204]:
         # Delete from local DB
-        conn = sqlite3.connect(db_path)
+        conn = get_db()
         conn.execute("DELETE FROM virtual_keys WHERE vk_id = ? AND serial_number = ? AND tenant_db = ?",
                      (vk_id, serial, tenant))
+        _invalidate_keys_hash(conn, tenant, [serial])
+        _close_circuits(conn, tenant, [serial])
         conn.commit()
-        conn.close()
         add_log(request.cookies.get('user_email'), "DELETE_VK", serial, {"vk_id": vk_id})
         return jsonify({"status": "deleted"})
 
+    if is_device_error(res.status_code):
+        conn = get_db()
+        _mark_faulty(conn, tenant, [(serial, res.status_code)])
+        conn.commit()
     add_log(request.cookies.get('user_email'), "DELETE_VK_ERROR", serial, {"vk_id": vk_id, "status": res.status_code})
     return jsonify({"error": "Failed to delete key", "details": res.text}), res.status_code
 
 @app.route('/delete-all-keys/<serial>', methods=['DELETE'])
 def delete_all_keys(serial):
     """Delete all virtual keys from a single device"""
-    token, tenant = request.cookies.get('access_token'), request.cookies.get('tenant')
+    token, tenant = _session()
     if not token: return jsonify({"error": "No session"}), 401
 
-    conn = sqlite3.connect(db_path)
+    conn = get_db()
     cur = conn.cursor()
     cur.execute("SELECT vk_id FROM virtual_keys WHERE serial_number = ? AND tenant_db = ?", (serial, tenant))
     keys = cur.fetchall()
@@ -251,87 +1623,359 @@ def delete_all_keys(serial):
     deleted = 0
     errors = []
     for (vk_id,) in keys:
-        res = requests.delete(f"{GEOTAB_BASE_URL}/tenants/{tenant}/devices/{serial}/virtual-keys/{vk_id}",
-                              headers={"Authorization": f"Bearer {token}"})
+        res = geotab.delete_virtual_key(token, tenant, serial, vk_id)
         if res.status_code in [200, 202, 204]:
             conn.execute("DELETE FROM virtual_keys WHERE vk_id = ?", (vk_id,))
             deleted += 1
         else:
-            errors.append({"vk_id": vk_id, "error": res.text})
+            errors.append({"vk_id": vk_id, "status": res.status_code, "error": res.text})
 
+    if deleted > 0:
+        _invalidate_keys_hash(conn, tenant, [serial])
+        _close_circuits(conn, tenant, [serial])
+    elif errors and is_device_error(errors[-1]["status"]):
+        _mark_faulty(conn, tenant, [(serial, errors[-1]["status"])])
     conn.commit()
-    conn.close()
 
     if deleted > 0:
         add_log(request.cookies.get('user_email'), "DELETE_ALL_VK", serial, {"deleted": deleted, "errors": len(errors)})
 
     return jsonify({"status": "completed", "deleted": deleted, "errors": errors})
 
+def _delete_handlers(tenant, token, user, params):
+    def work(serial, attempt):
+        with db_pool.connection() as conn:
+            keys = [r[0] for r in conn.execute("SELECT vk_id FROM virtual_keys WHERE serial_number = ? AND tenant_db = ?",
+                                               (serial, tenant))]
+        deleted, errors = [], []
+        for vk_id in keys:
+            res = geotab.delete_virtual_key(token, tenant, serial, vk_id)
+            # En un reintento, un 404 significa que el borrado anterior sí llegó a Geotab
+            if res.status_code in [200, 202, 204] or (attempt > 1 and res.status_code == 404):
+                deleted.append(vk_id)
+            else:
+                errors.append({"vk_id": vk_id, "status": res.status_code, "error": res.text[:200]})
+        outcome = {"serial": serial, "status": "error" if errors else "ok", "deleted": deleted, "errors": errors}
+        if errors and not deleted:
+            outcome["http_status"] = errors[-1]["status"]
+        return outcome
+
+    def apply(conn, batch):
+        conn.executemany("DELETE FROM virtual_keys WHERE vk_id = ?",
+                         [(vk_id,) for o in batch for vk_id in o.get("deleted", [])])
+        _invalidate_keys_hash(conn, tenant, [o["serial"] for o in batch if o.get("deleted")])
+        # Igual que sync, alta y renovación: un borrado que llega cierra el circuito, un 404/410 lo abre
+        _close_circuits(conn, tenant, [o["serial"] for o in batch if o.get("deleted")])
+        _mark_faulty(conn, tenant, [(o["serial"], o["http_status"]) for o in batch if is_device_error(o.get("http_status", 0))])
+
+    def on_finish(job):
+        with db_pool.connection() as conn:
+            deleted = sum(len(json.loads(r[0]).get("deleted", [])) for r in conn.execute(
+                "SELECT result FROM bulk_job_items WHERE job_id = ? AND result IS NOT NULL", (job.id,)))
+        if deleted > 0:
+            add_log(user, "BULK_DELETE_VK", ",".join(job.serials), {"deleted": deleted, "devices": job.total,
+                                                                   "skipped": params.get("skipped", 0), "job_id": job.id})
+
+    return work, apply, on_finish
+
 @app.route('/delete-keys-bulk', methods=['POST'])
 def delete_keys_bulk():
-    """Delete all virtual keys from multiple selected devices"""
-    token, tenant = request.cookies.get('access_token'), request.cookies.get('tenant')
+    """Delete all virtual keys from multiple selected devices as a background job"""
+    token, tenant = _session()
     if not token: return jsonify({"error": "No session"}), 401
+    data = request.json or {}
 
-    serials = request.json.get('serials', [])
+    serials = _requested_serials(data)
     if not serials: return jsonify({"error": "No devices selected"}), 400
 
-    results = {"total_deleted": 0, "devices_processed": 0, "errors": []}
-
-    conn = sqlite3.connect(db_path)
-    cur = conn.cursor()
-
-    for serial in serials:
-        cur.execute("SELECT vk_id FROM virtual_keys WHERE serial_number = ? AND tenant_db = ?", (serial, tenant))
-        keys = cur.fetchall()
-
-        for (vk_id,) in keys:
-            res = requests.delete(f"{GEOTAB_BASE_URL}/tenants/{tenant}/devices/{serial}/virtual-keys/{vk_id}",
-                                  headers={"Authorization": f"Bearer {token}"})
-            if res.status_code in [200, 202, 204]:
-                conn.execute("DELETE FROM virtual_keys WHERE vk_id = ?", (vk_id,))
-                results["total_deleted"] += 1
-            else:
-                results["errors"].append({"serial": serial, "vk_id": vk_id, "error": res.text})
-
-        results["devices_processed"] += 1
+    serials, skipped = _circuit_filter(get_db(), tenant, serials, data.get('include_open'))
+    job = start_bulk_job("delete", tenant, token, request.cookies.get('user_email'), serials, {"skipped": len(skipped)},
+                         data, resolved=skipped)
+    return _job_response(job, data)
 
-    conn.commit()
-    conn.close()
+def _expiry_window(args):
+    """(from_ms, until_ms) for ?within=<days>; ?include_expired=1 also returns keys already expired"""
+    within = float(args.get('within', RENEW_DEFAULT_DAYS))
+    now = time.time() * 1000
+    return (0 if args.get('include_expired') in ('1', 'true') else int(now)), int(now + within * 86400000)
 
-    if results["total_deleted"] > 0:
-        add_log(request.cookies.get('user_email'), "BULK_DELETE_VK", ",".join(serials),
-                {"deleted": results["total_deleted"], "devices": len(serials)})
-
-    return jsonify(results)
+@app.route('/keys/expiring', methods=['GET'])
+def expiring_keys():
+    """Keys expiring within ?within= days (default 30), soonest first; paged with ?limit= and ?cursor="""
+    tenant = request.args.get('tenant') or request.cookies.get('tenant')
+    try:
+        since, until = _expiry_window(request.args)
+        limit = max(1, min(int(request.args.get('limit', VEHICLES_MAX_PAGE)), VEHICLES_MAX_PAGE))
+        after = _decode_cursor(request.args['cursor']) if request.args.get('cursor') else None
+    except (ValueError, TypeError):
+        return jsonify({"error": "Invalid within, limit or cursor"}), 400
+    conn = get_db()
+    where, params = "k.tenant_db = ? AND k.expires_at >= ? AND k.expires_at < ?", [tenant, since, until]
+    total = conn.execute(f"SELECT COUNT(*), COUNT(DISTINCT serial_number) FROM virtual_keys k WHERE {where}", params).fetchone()
+    if after is not None:
+        where += " AND (k.expires_at, k.vk_id) > (?, ?)"
+        params += list(after)
+    rows = conn.execute(f"""SELECT k.vk_id, k.serial_number, k.user_ref, k.expires_at, k.template_id, v.description
+                            FROM virtual_keys k LEFT JOIN vehicles v ON v.serial_number = k.serial_number AND v.tenant_db = k.tenant_db
+                            WHERE {where} ORDER BY k.expires_at, k.vk_id LIMIT ?""", params + [limit + 1]).fetchall()
+    next_cursor = _encode_cursor(rows[limit - 1][3], rows[limit - 1][0]) if len(rows) > limit else None
+    return jsonify({"total": total[0], "devices": total[1], "next_cursor": next_cursor,
+                    "items": [{"vk_id": r[0], "serial": r[1], "user_ref": r[2], "expires_at": r[3],
+                               "template_id": r[4], "desc": r[5]} for r in rows[:limit]]})
+
+def _renew_handlers(tenant, token, user, params):
+    """Re-issue every key of a device expiring before params["until"] from its own template (or the fallback
+    template) with its original user reference; the old key is deleted once the new one exists"""
+    since, until = params["since"], params["until"]
+    months, fallback = params.get("duration_months"), params.get("template_id")
+    payloads, payloads_lock = {}, threading.Lock()
+
+    def payload_for(conn, template_id, user_ref):
+        """Payload for one key, or a message saying why it cannot be renewed"""
+        # Cada plantilla se compila y sella una vez por trabajo; solo cambia el userReference
+        with payloads_lock:
+            if template_id not in payloads:
+                try:
+                    tpl = _load_template(conn, tenant, template_id)
+                    payloads[template_id] = _template_payload(tpl, None, months) if tpl else "Template not found"
+                except ValueError as e:
+                    payloads[template_id] = str(e)
+        base = payloads[template_id]
+        return base if isinstance(base, str) else {**base, "userReference": user_ref or base["userReference"]}
+
+    def device_full(serial, vk_id):
+        """A 400 only means the key limit when Geotab lists MAX_KEYS_PER_DEVICE keys, the old one among them"""
+        res = geotab.list_virtual_keys(token, tenant, serial)
+        keys = res.json().get('virtualKeys', []) if res.status_code == 200 else []
+        return len(keys) >= MAX_KEYS_PER_DEVICE and any(vk.get('virtualKeyId') == vk_id for vk in keys)
+
+    def work(serial, attempt):
+        with db_pool.connection() as conn:
+            keys = conn.execute("""SELECT vk_id, user_ref, expires_at, template_id FROM virtual_keys
+                                   WHERE serial_number = ? AND tenant_db = ? AND expires_at >= ? AND expires_at < ?""",
+                                (serial, tenant, since, until)).fetchall()
+            jobs = []
+            for vk_id, ref, expires, template_id in keys:
+                template_id = template_id or fallback
+                jobs.append((vk_id, template_id, payload_for(conn, template_id, ref) if template_id else "No template to renew from"))
+        existing = None
+        if attempt > 1:
+            res = geotab.list_virtual_keys(token, tenant, serial)
+            existing = res.json().get('virtualKeys', []) if res.status_code == 200 else None
+        renewed, errors = [], []
+        for i, (vk_id, template_id, payload) in enumerate(jobs):
+            if isinstance(payload, str):
+                errors.append({"vk_id": vk_id, "error": payload})
+                continue
+            # Reintento: una llave con la misma referencia que caduca fuera de la ventana ya es la renovación
+            done = next((vk for vk in existing or [] if vk.get('userReference') == payload['userReference']
+                         and vk.get('virtualKeyId') != vk_id and (vk.get('endingTimestamp') or 0) >= until), None)
+            if not done:
+                res = geotab.create_virtual_key(token, tenant, serial, payload)
+                if res.status_code == 400 and device_full(serial, vk_id):
+                    # Dispositivo lleno: se libera el hueco de la llave antigua antes de crear la nueva
+                    freed = geotab.delete_virtual_key(token, tenant, serial, vk_id)
+                    if freed.status_code in (200, 202, 204):
+                        res = geotab.create_virtual_key(token, tenant, serial, payload)
+                        if res.status_code != 200:
+                            # La llave antigua ya no existe en Geotab: se informa y el resto del dispositivo no se toca
+                            errors.append({"vk_id": vk_id, "http_status": res.status_code, "error": res.text[:200],
+                                           "old_deleted": True, "replaced": False})
+                            errors += [{"vk_id": other, "error": "Not attempted: an earlier key of the device was deleted "
+                                                                  "and could not be replaced"} for other, _, _ in jobs[i + 1:]]
+                            break
+                if res.status_code != 200:
+                    errors.append({"vk_id": vk_id, "http_status": res.status_code, "error": res.text[:200]})
+                    continue
+                done = res.json()
+            res = geotab.delete_virtual_key(token, tenant, serial, vk_id)
+            renewed.append({"old": vk_id, "vk": done, "template_id": template_id,
+                            "old_deleted": res.status_code in (200, 202, 204, 404)})
+        return {"serial": serial, "status": "error" if errors else "ok", "renewed": renewed, "errors": errors}
+
+    def apply(conn, batch):
+        for o in batch:
+            for r in o["renewed"]:
+                _store_created_key(conn, o["serial"], tenant, r["vk"], r["template_id"])
+                if r["old_deleted"]:
+                    conn.execute("DELETE FROM virtual_keys WHERE vk_id = ?", (r["old"],))
+                add_log(user, "RENEW_VK", o["serial"], {"old_vk_id": r["old"], "new_vk_id": r["vk"]["virtualKeyId"],
+                                                         "template_id": r["template_id"], "userRef": r["vk"].get("userReference")})
+            for e in o["errors"]:
+                if e.get("old_deleted"):
+                    conn.execute("DELETE FROM virtual_keys WHERE vk_id = ?", (e["vk_id"],))
+                add_log(user, "RENEW_VK_ERROR", o["serial"], e)
+            # Resumen compacto en bulk_job_items
+            o["renewed"] = [{"old": r["old"], "new": r["vk"]["virtualKeyId"]} for r in o["renewed"]]
+
+    def on_finish(job):
+        with db_pool.connection() as conn:
+            renewed = sum(len(json.loads(r[0]).get("renewed", [])) for r in conn.execute(
+                "SELECT result FROM bulk_job_items WHERE job_id = ? AND result IS NOT NULL", (job.id,)))
+        add_log(user, "BULK_RENEW_VK", f"{job.total} devices",
+                {"renewed": renewed, "devices_ok": job.done, "devices_failed": job.failed, "job_id": job.id})
+
+    return work, apply, on_finish
+
+@app.route('/keys/renew', methods=['POST'])
+def renew_keys():
+    """Renew every key expiring within {"within": days} as a background job.
+    Optional: "template_id" for keys without one, "duration_months", "include_expired", "serials" to restrict."""
+    token, tenant = _session()
+    if not token: return jsonify({"error": "No session"}), 401
+    data = request.json or {}
+    try:
+        since, until = _expiry_window({k: str(v).lower() for k, v in data.items() if k in ("within", "include_expired")})
+    except ValueError:
+        return jsonify({"error": "Invalid within"}), 400
+    conn = get_db()
+    if data.get('template_id'):
+        try:
+            tpl = _load_template(conn, tenant, data['template_id'])
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 422
+        if not tpl: return jsonify({"error": "Template not found"}), 404
+
+    serials = [r[0] for r in conn.execute("""SELECT DISTINCT serial_number FROM virtual_keys
+                                             WHERE tenant_db = ? AND expires_at >= ? AND expires_at < ?""", (tenant, since, until))]
+    if data.get('serials'):
+        wanted = set(_requested_serials(data))
+        serials = [s for s in serials if s in wanted]
+    if not serials: return jsonify({"error": "No keys expire in that window"}), 400
+
+    serials, skipped = _circuit_filter(conn, tenant, serials, data.get('include_open'))
+    params = {"since": since, "until": until, "template_id": data.get('template_id'), "duration_months": data.get('duration_months')}
+    job = start_bulk_job("renew", tenant, token, request.cookies.get('user_email'), serials, params, data, resolved=skipped)
+    return _job_response(job, data)
 
 @app.route('/import-csv', methods=['POST'])
 def import_csv():
+    """Stream-import a CSV of serial,description[,tenant] rows; returns inserted/updated/skipped/duplicate counts
+    with line numbers for the rows that were not applied"""
     tenant = request.cookies.get('tenant') or request.args.get('tenant')
     if not tenant: return jsonify({"error": "Defina una Database primero"}), 400
-    file = request.files['file']
-    stream = io.StringIO(file.stream.read().decode("UTF8"))
-    conn = sqlite3.connect(db_path)
-    imported = 0
-    for row in csv.reader(stream):
-        if len(row) >= 2:
-            v_tenant = row[2].strip() if len(row) >= 3 else tenant
-            conn.execute("INSERT OR REPLACE INTO vehicles (serial_number, description, tenant_db) VALUES (?, ?, ?)",
-                         (row[0].strip(), row[1].strip(), v_tenant))
-            imported += 1
-    conn.commit()
-    conn.close()
-    add_log(request.cookies.get('user_email'), "IMPORT_CSV", f"{imported} devices", {"count": imported})
-    return jsonify({"status": "done", "imported": imported})
+    file = request.files.get('file')
+    if not file: return jsonify({"error": "No file"}), 400
+
+    conn = get_db()
+    encoding = _detect_csv_encoding(file.stream)
+    try:
+        try:
+            report = _import_rows(conn, file.stream, encoding, tenant)
+        except UnicodeDecodeError:
+            # Los primeros IMPORT_SNIFF_BYTES eran UTF-8 pero el resto no: se repite entero como Windows-1252
+            conn.rollback()
+            file.stream.seek(0)
+            encoding = "cp1252"
+            report = _import_rows(conn, file.stream, encoding, tenant)
+        conn.commit()
+    finally:
+        conn.execute("DROP TABLE IF EXISTS temp.import_seen")
+
+    report["encoding"] = encoding
+    report["imported"] = report["inserted"] + report["updated"] + report["unchanged"]
+    add_log(request.cookies.get('user_email'), "IMPORT_CSV", f"{report['imported']} devices",
+            {k: report[k] for k in ("imported", "inserted", "updated", "skipped", "duplicates")})
+    return jsonify({"status": "done", **report})
+
+def _import_rows(conn, raw, encoding, tenant):
+    """Parse and upsert every row (no commit). UTF-8 is decoded strictly so a bad byte after the sniffed
+    block raises UnicodeDecodeError; other encodings replace undecodable bytes and report those rows."""
+    # Claves ya vistas en el fichero: en una tabla temporal, no en memoria, para que un fichero grande no la agote
+    conn.execute("""CREATE TEMP TABLE IF NOT EXISTS import_seen
+                    (serial TEXT NOT NULL, tenant TEXT NOT NULL, line INTEGER NOT NULL, PRIMARY KEY (serial, tenant))""")
+    conn.execute("DELETE FROM import_seen")
+    strict = encoding.startswith("utf-8")
+    stream = io.TextIOWrapper(raw, encoding=encoding, errors="strict" if strict else "replace", newline="")
+    report = {"inserted": 0, "updated": 0, "unchanged": 0, "skipped": 0, "duplicates": 0, "replaced": 0,
+              "skipped_rows": [], "duplicate_rows": [], "replaced_rows": []}
+    batch = []
+    try:
+        reader = csv.reader(stream)
+        for row in reader:
+            line = reader.line_num
+            if not any(cell.strip() for cell in row):
+                continue
+            if line == 1 and row[0].strip().lower().replace(" ", "_") in ("serial", "serial_number", "serialnumber"):
+                continue  # cabecera
+            serial = row[0].strip()
+            if len(row) < 2 or not serial:
+                _import_issue(report, "skipped", "skipped_rows", {"line": line, "serial": serial or None,
+                                                  "reason": "Missing serial" if len(row) >= 2 else "Expected serial,description"})
+                continue
+            if not strict and any("\ufffd" in cell for cell in row):
+                _import_issue(report, "replaced", "replaced_rows", {"line": line, "serial": serial})
+            v_tenant = (row[2].strip() if len(row) >= 3 else "") or tenant
+            batch.append((serial, row[1].strip(), v_tenant, line))
+            if len(batch) >= IMPORT_BATCH_ROWS:
+                _import_batch(conn, batch, report)
+                batch = []
+        if batch:
+            _import_batch(conn, batch, report)
+    finally:
+        stream.detach()  # el fichero subido sigue abierto por si hay que releerlo
+    return report
+
+def _detect_csv_encoding(raw):
+    """BOM first (UTF-8/UTF-16); otherwise UTF-8 if the first block decodes, else Windows-1252 (Excel)"""
+    head = raw.read(IMPORT_SNIFF_BYTES)
+    raw.seek(0)
+    if head.startswith(b"\xef\xbb\xbf"):
+        return "utf-8-sig"
+    if head.startswith((b"\xff\xfe", b"\xfe\xff")):
+        return "utf-16"
+    try:
+        codecs.getincrementaldecoder("utf-8")().decode(head, final=False)
+        return "utf-8"
+    except UnicodeDecodeError:
+        return "cp1252"
+
+def _import_issue(report, kind, rows_key, entry):
+    report[kind] += 1
+    if len(report[rows_key]) < IMPORT_REPORT_MAX:
+        report[rows_key].append(entry)
+
+def _import_batch(conn, batch, report):
+    """Upsert one batch of (serial, desc, tenant, line) rows (no commit); existing rows keep their faulty flag
+    and sync state. A row whose serial was already seen earlier in the file (import_seen) is a duplicate."""
+    existing, seen = {}, {}
+    for tenant, rows in groupby(sorted(batch, key=lambda r: r[2]), key=lambda r: r[2]):
+        serials = list({r[0] for r in rows})
+        for part in _chunks(serials):
+            marks = ','.join('?' * len(part))
+            existing.update(((r[0], tenant), r[1]) for r in conn.execute(
+                f"""SELECT serial_number, description FROM vehicles
+                    WHERE tenant_db = ? AND serial_number IN ({marks})""", [tenant, *part]))
+            seen.update(((r[0], tenant), r[1]) for r in conn.execute(
+                f"SELECT serial, line FROM import_seen WHERE tenant = ? AND serial IN ({marks})", [tenant, *part]))
+    fresh = []
+    for serial, desc, tenant, line in batch:
+        if (serial, tenant) in seen:
+            _import_issue(report, "duplicates", "duplicate_rows", {"line": line, "serial": serial, "first_line": seen[(serial, tenant)]})
+            continue
+        seen[(serial, tenant)] = line
+        fresh.append((serial, desc, tenant, line))
+    conn.executemany("INSERT INTO import_seen (serial, tenant, line) VALUES (?, ?, ?)", [(s, t, l) for s, _, t, l in fresh])
+    changed = []
+    for serial, desc, tenant, _ in fresh:
+        if (serial, tenant) not in existing:
+            report["inserted"] += 1
+            changed.append((serial, desc, tenant))
+        elif existing[(serial, tenant)] != desc:
+            report["updated"] += 1
+            changed.append((serial, desc, tenant))
+        else:
+            report["unchanged"] += 1
+    conn.executemany("""INSERT INTO vehicles (serial_number, description, tenant_db) VALUES (?, ?, ?)
+                        ON CONFLICT(serial_number, tenant_db) DO UPDATE SET description = excluded.description""", changed)
 
 @app.route('/vehicles/<serial>', methods=['DELETE'])
 def delete_vehicle_local(serial):
     tenant = request.cookies.get('tenant')
-    conn = sqlite3.connect(db_path)
+    conn = get_db()
     conn.execute("DELETE FROM vehicles WHERE serial_number = ? AND tenant_db = ?", (serial, tenant))
     conn.execute("DELETE FROM virtual_keys WHERE serial_number = ? AND tenant_db = ?", (serial, tenant))
     conn.commit()
-    conn.close()
     add_log(request.cookies.get('user_email'), "DELETE_DEVICE", serial, {})
     return jsonify({"status": "deleted"})
 
@@ -342,73 +1986,99 @@ def delete_vehicles_bulk():
     serials = request.json.get('serials', [])
     if not serials: return jsonify({"error": "No devices selected"}), 400
 
-    conn = sqlite3.connect(db_path)
+    conn = get_db()
     deleted = 0
     for serial in serials:
         conn.execute("DELETE FROM vehicles WHERE serial_number = ? AND tenant_db = ?", (serial, tenant))
         conn.execute("DELETE FROM virtual_keys WHERE serial_number = ? AND tenant_db = ?", (serial, tenant))
         deleted += 1
     conn.commit()
-    conn.close()
 
     add_log(request.cookies.get('user_email'), "BULK_DELETE_DEVICES", ",".join(serials), {"count": deleted})
     return jsonify({"status": "deleted", "count": deleted})
 
+def _format_expiry(ts, iso=False):
+    if not ts: return 'N/A'
+    dt = datetime.fromtimestamp(ts / 1000)
+    return dt.isoformat(timespec='seconds') if iso else dt.strftime('%Y-%m-%d')
+
 @app.route('/export-csv', methods=['GET'])
 def export_csv():
-    """Export vehicles and keys to CSV"""
+    """Export vehicles and keys to CSV, streamed from one joined query.
+    full=1 writes one row per key with the complete key id and ISO-8601 expiry."""
     tenant = request.cookies.get('tenant')
     if not tenant: return jsonify({"error": "No session"}), 401
-
-    conn = sqlite3.connect(db_path)
-    cur = conn.cursor()
-    cur.execute("SELECT serial_number, description FROM vehicles WHERE tenant_db = ?", (tenant,))
-    vehicles = cur.fetchall()
-
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(['Serial', 'Description', 'Key Count', 'Keys (UserRef | ID | Expires)'])
-
-    for v in vehicles:
-        cur.execute("SELECT vk_id, user_ref, expires_at FROM virtual_keys WHERE serial_number = ? AND tenant_db = ?", (v[0], tenant))
-        keys = cur.fetchall()
-        key_info = "; ".join([f"{k[1] or 'N/A'} | {k[0][:10]}... | {datetime.fromtimestamp(k[2]/1000).strftime('%Y-%m-%d') if k[2] else 'N/A'}" for k in keys])
-        writer.writerow([v[0], v[1], len(keys), key_info])
-
-    conn.close()
-
-    response = make_response(output.getvalue())
-    response.headers['Content-Type'] = 'text/csv'
+    full = request.args.get('full', 'false') in ('1', 'true')
+
+    def generate():
+        with db_pool.connection() as conn:
+            cur = conn.execute("""SELECT v.serial_number, v.description, k.vk_id, k.user_ref, k.expires_at
+                                  FROM vehicles v LEFT JOIN virtual_keys k
+                                  ON k.serial_number = v.serial_number AND k.tenant_db = v.tenant_db
+                                  WHERE v.tenant_db = ? ORDER BY v.serial_number, k.rowid""", (tenant,))
+            output = io.StringIO()
+            writer = csv.writer(output)
+            if full:
+                writer.writerow(['Serial', 'Description', 'Key Count', 'Key ID', 'UserRef', 'Expires'])
+            else:
+                writer.writerow(['Serial', 'Description', 'Key Count', 'Keys (UserRef | ID | Expires)'])
+
+            for n, (serial, rows) in enumerate(groupby(cur, key=lambda r: r[0]), 1):
+                rows = list(rows)
+                desc = rows[0][1]
+                keys = [r[2:] for r in rows if r[2] is not None]
+                if full:
+                    for k in keys:
+                        writer.writerow([serial, desc, len(keys), k[0], k[1] or '', _format_expiry(k[2], iso=True)])
+                    if not keys:
+                        writer.writerow([serial, desc, 0, '', '', ''])
+                else:
+                    key_info = "; ".join([f"{k[1] or 'N/A'} | {k[0][:10]}... | {_format_expiry(k[2])}" for k in keys])
+                    writer.writerow([serial, desc, len(keys), key_info])
+                if n % EXPORT_CHUNK_ROWS == 0:
+                    yield output.getvalue()
+                    output.seek(0)
+                    output.truncate(0)
+            yield output.getvalue()
+
+    response = Response(generate(), mimetype='text/csv')
     response.headers['Content-Disposition'] = f'attachment; filename=vehicles_export_{tenant}_{datetime.now().strftime("%Y%m%d")}.csv'
     return response
 
 @app.route('/logs', methods=['GET', 'DELETE'])
 def get_logs():
-    conn = sqlite3.connect(db_path)
+    conn = get_db()
     cur = conn.cursor()
 
+    # Las filas aún en cola se escriben antes de leer o borrar
+    audit_writer.flush()
+
     if request.method == 'DELETE':
         user = request.cookies.get('user_email')
         cur.execute("DELETE FROM logs")
         conn.commit()
-        conn.close()
         # Log the reset action (this will be the first entry in the clean log)
         add_log(user, "RESET_LOGS", "ALL", {})
         return jsonify({"status": "logs cleared"})
 
-    cur.execute("SELECT * FROM logs ORDER BY id DESC LIMIT 50")
+    # Filtros opcionales ?action= / ?serial= (índices idx_logs_action / idx_logs_serial)
+    sql, params = "SELECT * FROM logs", []
+    for column in ("action", "serial"):
+        if request.args.get(column):
+            sql += f" {'AND' if params else 'WHERE'} {column} = ?"
+            params.append(request.args[column])
+    cur.execute(sql + " ORDER BY id DESC LIMIT 50", params)
     logs = [{"at": r[1], "user": r[2], "action": r[3], "serial": r[4]} for r in cur.fetchall()]
-    conn.close()
     return jsonify(logs)
 
 @app.route('/export-logs', methods=['GET'])
 def export_logs():
     """Export all logs as a text file"""
-    conn = sqlite3.connect(db_path)
+    audit_writer.flush()
+    conn = get_db()
     cur = conn.cursor()
     cur.execute("SELECT timestamp, user, action, serial, parameters FROM logs ORDER BY id DESC")
     logs = cur.fetchall()
-    conn.close()
 
     output = io.StringIO()
     output.write("=" * 80 + "\n")
@@ -433,12 +2103,17 @@ def export_logs():
 def logout():
     """End current session"""
     user = request.cookies.get('user_email')
-    tenant = request.cookies.get('tenant')
+    tenant = request.args.get('tenant') or request.cookies.get('tenant')
     add_log(user, "LOGOUT", tenant or "N/A", {})
+    token_store.leave(tenant, request.cookies.get('session_id'))
     resp = make_response(jsonify({"status": "logged_out"}))
-    resp.delete_cookie('access_token')
-    resp.delete_cookie('tenant')
-    resp.delete_cookie('user_email')
+    # ?tenant= cierra solo esa sesión; las cookies pertenecen a la del navegador
+    if tenant == request.cookies.get('tenant'):
+        resp.delete_cookie('access_token')
+        resp.delete_cookie('tenant')
+        if not token_store.describe(request.cookies.get('session_id')):
+            resp.delete_cookie('session_id')
+        resp.delete_cookie('user_email')
     return resp
 
 # ==================== TEMPLATE ENDPOINTS ====================
@@ -449,7 +2124,7 @@ def manage_templates():
     if not tenant:
         return jsonify({"error": "Tenant required"}), 400
 
-    conn = sqlite3.connect(db_path)
+    conn = get_db()
     cur = conn.cursor()
 
     if request.method == 'POST':
@@ -468,41 +2143,23 @@ def manage_templates():
                         data.get('duration_months', 12), created_at, user))
             conn.commit()
             add_log(user, "CREATE_TEMPLATE", data['name'], {"template_id": template_id})
-            conn.close()
             return jsonify({"id": template_id, "version": 1})
         except sqlite3.IntegrityError:
-            conn.close()
             return jsonify({"error": "Template name already exists"}), 409
 
-    # GET: List templates - check if user_ref column exists
-    cur.execute("PRAGMA table_info(vk_templates)")
-    columns = [info[1] for info in cur.fetchall()]
-    has_user_ref = 'user_ref' in columns
-
+    # GET: List templates
     include_archived = request.args.get('include_archived', 'false') == 'true'
 
-    if has_user_ref:
-        if include_archived:
-            cur.execute("""SELECT id, name, user_ref, nfc_tags, duration_months, version, is_active, created_at
-                          FROM vk_templates WHERE tenant_db = ? ORDER BY name, version DESC""", (tenant,))
-        else:
-            cur.execute("""SELECT id, name, user_ref, nfc_tags, duration_months, version, is_active, created_at
-                          FROM vk_templates WHERE tenant_db = ? AND is_active = 1 ORDER BY name""", (tenant,))
-        templates = [{"id": r[0], "name": r[1], "user_ref": r[2], "nfc_tags": json.loads(r[3]),
-                      "duration_months": r[4], "version": r[5], "is_active": bool(r[6]),
-                      "created_at": r[7]} for r in cur.fetchall()]
+    if include_archived:
+        cur.execute("""SELECT id, name, user_ref, nfc_tags, duration_months, version, is_active, created_at
+                      FROM vk_templates WHERE tenant_db = ? ORDER BY name, version DESC""", (tenant,))
     else:
-        if include_archived:
-            cur.execute("""SELECT id, name, nfc_tags, duration_months, version, is_active, created_at
-                          FROM vk_templates WHERE tenant_db = ? ORDER BY name, version DESC""", (tenant,))
-        else:
-            cur.execute("""SELECT id, name, nfc_tags, duration_months, version, is_active, created_at
-                          FROM vk_templates WHERE tenant_db = ? AND is_active = 1 ORDER BY name""", (tenant,))
-        templates = [{"id": r[0], "name": r[1], "user_ref": None, "nfc_tags": json.loads(r[2]),
-                      "duration_months": r[3], "version": r[4], "is_active": bool(r[5]),
-                      "created_at": r[6]} for r in cur.fetchall()]
+        cur.execute("""SELECT id, name, user_ref, nfc_tags, duration_months, version, is_active, created_at
+                      FROM vk_templates WHERE tenant_db = ? AND is_active = 1 ORDER BY name""", (tenant,))
+    templates = [{"id": r[0], "name": r[1], "user_ref": r[2], "nfc_tags": json.loads(r[3]),
+                  "duration_months": r[4], "version": r[5], "is_active": bool(r[6]),
+                  "created_at": r[7]} for r in cur.fetchall()]
 
-    conn.close()
     return jsonify(templates)
 
 @app.route('/templates/<template_id>', methods=['GET', 'PUT', 'DELETE'])
@@ -510,45 +2167,18 @@ def manage_template(template_id):
     tenant = request.cookies.get('tenant')
     user = request.cookies.get('user_email')
 
-    conn = sqlite3.connect(db_path)
+    conn = get_db()
     cur = conn.cursor()
 
     if request.method == 'GET':
-        # Check if user_ref column exists
-        cur.execute("PRAGMA table_info(vk_templates)")
-        columns = [info[1] for info in cur.fetchall()]
-        has_user_ref = 'user_ref' in columns
-
-        if has_user_ref:
-            cur.execute("""SELECT id, tenant_db, name, user_ref, vk_config, nfc_tags,
-                           duration_months, version, previous_version_id, is_active, created_at, created_by
-                           FROM vk_templates WHERE id = ? AND tenant_db = ?""", (template_id, tenant))
-        else:
-            cur.execute("""SELECT id, tenant_db, name, vk_config, nfc_tags,
-                           duration_months, version, previous_version_id, is_active, created_at, created_by
-                           FROM vk_templates WHERE id = ? AND tenant_db = ?""", (template_id, tenant))
-
-        row = cur.fetchone()
-        conn.close()
-        if not row:
+        try:
+            tpl = template_cache.get(conn, tenant, template_id)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 422
+        if not tpl:
             return jsonify({"error": "Template not found"}), 404
 
-        if has_user_ref:
-            return jsonify({
-                "id": row[0], "tenant_db": row[1], "name": row[2],
-                "user_ref": row[3], "vk_config": json.loads(row[4]), "nfc_tags": json.loads(row[5]),
-                "duration_months": row[6], "version": row[7],
-                "previous_version_id": row[8], "is_active": bool(row[9]),
-                "created_at": row[10], "created_by": row[11]
-            })
-        else:
-            return jsonify({
-                "id": row[0], "tenant_db": row[1], "name": row[2],
-                "user_ref": None, "vk_config": json.loads(row[3]), "nfc_tags": json.loads(row[4]),
-                "duration_months": row[5], "version": row[6],
-                "previous_version_id": row[7], "is_active": bool(row[8]),
-                "created_at": row[9], "created_by": row[10]
-            })
+        return jsonify({k: v for k, v in tpl.items() if k != "body"})
 
     if request.method == 'PUT':
         # Get current version info
@@ -556,7 +2186,6 @@ def manage_template(template_id):
                     (template_id, tenant))
         current = cur.fetchone()
         if not current:
-            conn.close()
             return jsonify({"error": "Template not found"}), 404
 
         data = request.json
@@ -580,9 +2209,9 @@ def manage_template(template_id):
                      template_id, created_at, user))
 
         conn.commit()
+        template_cache.invalidate(tenant, template_id)
         add_log(user, "UPDATE_TEMPLATE", data.get('name', old_name),
                 {"old_id": template_id, "new_id": new_id, "version": new_version})
-        conn.close()
         return jsonify({"id": new_id, "version": new_version, "previous_version_id": template_id})
 
     if request.method == 'DELETE':
@@ -590,7 +2219,6 @@ def manage_template(template_id):
         cur.execute("SELECT name FROM vk_templates WHERE id = ? AND tenant_db = ?", (template_id, tenant))
         row = cur.fetchone()
         if not row:
-            conn.close()
             return jsonify({"error": "Template not found"}), 404
 
         if hard_delete:
@@ -601,20 +2229,19 @@ def manage_template(template_id):
             add_log(user, "ARCHIVE_TEMPLATE", row[0], {"template_id": template_id})
 
         conn.commit()
-        conn.close()
+        template_cache.invalidate(tenant, template_id)
         return jsonify({"status": "deleted" if hard_delete else "archived"})
 
 @app.route('/templates/<template_id>/history', methods=['GET'])
 def get_template_history(template_id):
     tenant = request.cookies.get('tenant')
-    conn = sqlite3.connect(db_path)
+    conn = get_db()
     cur = conn.cursor()
 
     # Get the template name first
     cur.execute("SELECT name FROM vk_templates WHERE id = ? AND tenant_db = ?", (template_id, tenant))
     row = cur.fetchone()
     if not row:
-        conn.close()
         return jsonify({"error": "Template not found"}), 404
 
     # Get all versions with same name
@@ -623,10 +2250,691 @@ def get_template_history(template_id):
                   ORDER BY version DESC""", (tenant, row[0]))
     history = [{"id": r[0], "version": r[1], "created_at": r[2],
                 "created_by": r[3], "is_active": bool(r[4])} for r in cur.fetchall()]
-    conn.close()
     return jsonify(history)
 
+# ==================== BULK JOBS ====================
+
+class BulkJob:
+    """Live progress of a bulk operation; per-device state is persisted in bulk_job_items"""
+
+    def __init__(self, job_id, kind, tenant, user, serials, total=None, done=0, failed=0):
+        self.id, self.kind, self.tenant, self.user = job_id, kind, tenant, user
+        self.serials = serials
+        self.total = len(serials) if total is None else total
+        self.done = done
+        self.failed = failed
+        self.status = "running"
+        self.cancelled = False
+        self.started = time.monotonic()
+        self._resumed_from = done + failed
+        self._cond = threading.Condition()
+        self._version = 0
+
+    def record(self, outcomes):
+        with self._cond:
+            for o in outcomes:
+                if o["status"] == "ok":
+                    self.done += 1
+                else:
+                    self.failed += 1
+                metrics.inc("keyless_bulk_items_total", self.kind, o["status"])
+            self._version += 1
+            self._cond.notify_all()
+
+    def discard(self, outcomes):
+        """Undo record() for outcomes that were not stored (their lease went to another runner)"""
+        with self._cond:
+            for o in outcomes:
+                if o["status"] == "ok":
+                    self.done -= 1
+                else:
+                    self.failed -= 1
+            self._version += 1
+            self._cond.notify_all()
+
+    def finish(self, status="completed"):
+        with self._cond:
+            self.status = status
+            self._version += 1
+            self._cond.notify_all()
+
+    def snapshot(self):
+        processed = self.done + self.failed
+        elapsed = time.monotonic() - self.started
+        rate = (processed - self._resumed_from) / elapsed if elapsed > 0 else 0
+        remaining = self.total - processed
+        return {"id": self.id, "kind": self.kind, "tenant": self.tenant, "status": self.status,
+                "total": self.total, "done": self.done, "failed": self.failed, "remaining": remaining,
+                "elapsed_seconds": round(elapsed, 1), "throughput": round(rate, 2),
+                "eta_seconds": round(remaining / rate, 1) if rate and remaining else (0 if not remaining else None)}
+
+    def wait(self, version, timeout):
+        """Block until progress changes (or timeout); returns (version, snapshot)"""
+        with self._cond:
+            self._cond.wait_for(lambda: self._version != version, timeout)
+            return self._version, self.snapshot()
+
+bulk_jobs = {}
+bulk_jobs_lock = threading.Lock()
+# Trabajos cortados por el último reinicio; su autor los reanuda al volver a iniciar sesión
+restart_interrupted = set()
+
+# Fábricas (tenant, token, user, params) -> (work, apply, on_finish); permiten reanudar un trabajo tras reiniciar
+BULK_HANDLERS = {"sync": _sync_handlers, "create": _create_handlers, "delete": _delete_handlers, "renew": _renew_handlers}
+
+def _requested_serials(data):
+    return list(dict.fromkeys(s.strip() for s in data.get('serials', []) if s and s.strip()))
+
+def _bulk_workers(data):
+    try:
+        workers = int(data.get('concurrency', BULK_WORKERS))
+    except (TypeError, ValueError):
+        workers = BULK_WORKERS
+    return max(1, min(workers, BULK_MAX_WORKERS))
+
+def _persist_outcomes(conn, job, batch, owner=None):
+    """Store finished items still leased by `owner` (None: items never leased, e.g. resolved up front).
+    Outcomes of items whose lease went to another runner are not stored and leave the job counters."""
+    owned = set()
+    for part in _chunks([o["serial"] for o in batch]):
+        owned.update(r[0] for r in conn.execute(
+            f"""SELECT serial FROM bulk_job_items WHERE job_id = ? AND lease_owner IS ?
+                AND serial IN ({','.join('?' * len(part))})""", [job.id, owner, *part]))
+    lost = [o for o in batch if o["serial"] not in owned]
+    if lost:
+        logging.warning(f"Trabajo {job.id}: {len(lost)} resultados descartados, su lease pasó a otro proceso")
+        job.discard(lost)
+    now = datetime.now().isoformat()
+    conn.executemany("""UPDATE bulk_job_items SET status = ?, result = ?, finished_at = ?, lease_owner = NULL, lease_until = NULL
+                        WHERE job_id = ? AND serial = ? AND lease_owner IS ?""",
+                     [(o["status"], json.dumps({k: v for k, v in o.items() if k not in ("serial", "status")}),
+                       now, job.id, o["serial"], owner) for o in batch if o["serial"] in owned])
+    conn.execute("UPDATE bulk_jobs SET done = ?, failed = ? WHERE id = ?", (job.done, job.failed, job.id))
+
+def _extend_leases(conn, job, owner, serials):
+    """Keep the leases of items still queued, running or waiting to be written (no commit)"""
+    conn.executemany("UPDATE bulk_job_items SET lease_until = ? WHERE job_id = ? AND serial = ? AND lease_owner = ?",
+                     [(time.time() + JOB_LEASE_SECONDS, job.id, s, owner) for s in serials])
+
+def _lease_items(conn, job, limit, owner, busy=()):
+    """Lease up to `limit` pending (or expired) items of a job for `owner`, never the `busy` serials this
+    runner already holds. Returns [(serial, attempt)]."""
+    now = time.time()
+    busy = list(busy)
+    not_busy = f"AND serial NOT IN ({','.join('?' * len(busy))})" if busy else ""
+    # Elementos que agotaron sus intentos sin terminar se cierran como error
+    cur = conn.execute(f"""UPDATE bulk_job_items SET status = 'error', finished_at = ?, lease_owner = NULL,
+                          result = ? WHERE job_id = ? AND attempts >= ?
+                          AND (status = 'pending' OR (status = 'leased' AND lease_until < ?)) {not_busy}""",
+                       (datetime.now().isoformat(), json.dumps({"error": "Max attempts exceeded"}), job.id, JOB_MAX_ATTEMPTS,
+                        now, *busy))
+    if cur.rowcount:
+        job.record([{"status": "error"}] * cur.rowcount)
+    until = now + JOB_LEASE_SECONDS
+    conn.execute(f"""UPDATE bulk_job_items SET status = 'leased', lease_owner = ?, lease_until = ?, attempts = attempts + 1
+                     WHERE job_id = ? AND serial IN (
+                         SELECT serial FROM bulk_job_items WHERE job_id = ?
+                         AND (status = 'pending' OR (status = 'leased' AND lease_until < ?)) {not_busy} ORDER BY rowid LIMIT ?)""",
+                 (owner, until, job.id, job.id, now, *busy, limit))
+    leased = conn.execute("SELECT serial, attempts FROM bulk_job_items WHERE job_id = ? AND lease_owner = ? AND lease_until = ?",
+                          (job.id, owner, until)).fetchall()
+    conn.commit()
+    return leased
+
+# Span del dispositivo que procesa este hilo en un trabajo masivo (ver _traced); None fuera de ellos
+_trace = threading.local()
+
+def _trace_add(phase, amount):
+    span = getattr(_trace, "span", None)
+    if span is not None:
+        span[phase] += amount
+
+def _traced(work, serial, attempt, submitted):
+    """Run work(serial, attempt) on a worker thread and return (outcome, span). The span collects the
+    wait for a free worker, limiter waits and retry pauses, Geotab time, SQLite time and retries."""
+    started = time.perf_counter()
+    span = _trace.span = {"serial": serial, "attempt": attempt, "started_at": time.time(), "queue": started - submitted,
+                          "throttle": 0.0, "upstream": 0.0, "db": 0.0, "retries": 0}
+    try:
+        outcome = work(serial, attempt)
+    except requests.RequestException as e:
+        outcome = {"serial": serial, "status": "error", "error": str(e)[:200]}
+    finally:
+        _trace.span = None
+        span["local"] = max(0.0, time.perf_counter() - started - span["throttle"] - span["upstream"] - span["db"])
+    return outcome, span
+
+def _store_spans(conn, job, spans):
+    if TRACE_JOBS_KEPT > 0:
+        conn.executemany("INSERT INTO bulk_spans VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                         [(job.id, s["serial"], s["attempt"], round(s["started_at"], 3),
+                           *(round(s[phase] * 1000, 2) for phase in TRACE_PHASES), s["status"], s["http_status"], s["retries"])
+                          for s in spans])
+
+def _prune_spans(conn):
+    """Keep the spans of the newest TRACE_JOBS_KEPT jobs"""
+    keep = {r[0] for r in conn.execute("SELECT id FROM bulk_jobs ORDER BY created_at DESC LIMIT ?", (max(TRACE_JOBS_KEPT, 0),))}
+    old = [r[0] for r in conn.execute("SELECT DISTINCT job_id FROM bulk_spans") if r[0] not in keep]
+    conn.executemany("DELETE FROM bulk_spans WHERE job_id = ?", [(j,) for j in old])
+
+def _run_bulk(job, work, apply, workers=BULK_WORKERS):
+    """Lease items of the job from SQLite and run work(serial, attempt) on a bounded thread pool.
+    Outcomes are handed to apply(conn, batch) and stored with the item state in grouped transactions
+    of DB_WRITE_BATCH devices (or every DB_WRITE_INTERVAL seconds). Every attempt leaves a span in bulk_spans.
+    All leases of the run share one owner and are extended while their items are queued or running."""
+    pending, spans, unsaved, in_flight, last_write = [], [], [], {}, time.monotonic()
+    owner, last_extend = uuid.uuid4().hex, time.monotonic()
+    with db_pool.connection() as conn:
+        def write(batch, batch_spans):
+            started = time.perf_counter()
+            apply(conn, batch)
+            _persist_outcomes(conn, job, batch, owner)
+            _store_spans(conn, job, unsaved)
+            conn.commit()
+            # El tiempo de la transacción se reparte entre los dispositivos del lote; sus spans van en la siguiente
+            share = (time.perf_counter() - started) / len(batch)
+            for outcome, span in zip(batch, batch_spans):
+                span.update(db=span["db"] + share, status=outcome["status"], http_status=outcome.get("http_status"))
+            unsaved[:] = batch_spans
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            while True:
+                if len(in_flight) <= workers and not job.cancelled:
+                    if pending:
+                        write(pending, spans)
+                        pending, spans, last_write = [], [], time.monotonic()
+                    for serial, attempt in _lease_items(conn, job, workers * 4, owner, in_flight.values()):
+                        in_flight[pool.submit(_traced, work, serial, attempt, time.perf_counter())] = serial
+                if not in_flight:
+                    break
+                if time.monotonic() - last_extend >= JOB_LEASE_SECONDS / 3:
+                    # Colas largas o pausas por Retry-After no deben dejar caducar el lease de lo que sigue en curso
+                    _extend_leases(conn, job, owner, [*in_flight.values(), *(o["serial"] for o in pending)])
+                    conn.commit()
+                    last_extend = time.monotonic()
+                finished, _ = wait(in_flight, timeout=min(DB_WRITE_INTERVAL, JOB_LEASE_SECONDS / 3), return_when=FIRST_COMPLETED)
+                for fut in finished:
+                    in_flight.pop(fut)
+                    outcome, span = fut.result()
+                    job.record([outcome])
+                    pending.append(outcome)
+                    spans.append(span)
+                if pending and (len(pending) >= DB_WRITE_BATCH or time.monotonic() - last_write >= DB_WRITE_INTERVAL):
+                    write(pending, spans)
+                    pending, spans, last_write = [], [], time.monotonic()
+        if pending:
+            write(pending, spans)
+        if unsaved:
+            _store_spans(conn, job, unsaved)
+            conn.commit()
+
+def _launch(job, token, params, workers):
+    work, apply, on_finish = BULK_HANDLERS[job.kind](job.tenant, token, job.user, params)
+    with bulk_jobs_lock:
+        bulk_jobs[job.id] = job
+        finished = [j for j in bulk_jobs.values() if j.status != "running"]
+        for old in finished[:max(0, len(finished) - JOBS_KEPT_IN_MEMORY)]:
+            del bulk_jobs[old.id]
+
+    def run():
+        status = "completed"
+        try:
+            _run_bulk(job, work, apply, workers)
+            if job.cancelled:
+                status = "cancelled"
+        except Exception:
+            logging.exception(f"Trabajo {job.id} ({job.kind}) interrumpido")
+            status = "failed"
+        with db_pool.connection() as conn:
+            if status == "cancelled":
+                conn.execute("UPDATE bulk_job_items SET status = 'cancelled' WHERE job_id = ? AND status = 'pending'", (job.id,))
+            conn.execute("UPDATE bulk_jobs SET status = ?, done = ?, failed = ?, finished_at = ? WHERE id = ?",
+                         (status, job.done, job.failed, datetime.now().isoformat(), job.id))
+            _prune_spans(conn)
+            conn.commit()
+        job.finish(status)
+        if on_finish:
+            on_finish(job)
+        logging.info(f"Trabajo {job.id} ({job.kind}) {status}: {job.done} ok, {job.failed} con error")
+
+    threading.Thread(target=run, name=f"bulk-{job.id}", daemon=True).start()
+    return job
+
+def start_bulk_job(kind, tenant, token, user, serials, params, data, resolved=()):
+    """Enqueue serials as a durable job and run it in a background thread. `resolved` holds outcomes
+    decided up front (e.g. devices skipped by validation) that are recorded without calling work.
+    A repeated data["idempotency_key"] returns the job already created for it."""
+    workers = _bulk_workers(data)
+    idempotency_key = data.get('idempotency_key')
+    with db_pool.connection() as conn:
+        existing = idempotency_key and _idempotent_job(conn, idempotency_key)
+        if existing:
+            return existing
+        job = BulkJob(f"job_{uuid.uuid4().hex[:12]}", kind, tenant, user, serials)
+        # Visible en memoria antes del commit: una petición repetida que choque con el índice único lo encuentra
+        with bulk_jobs_lock:
+            bulk_jobs[job.id] = job
+        try:
+            conn.execute("""INSERT INTO bulk_jobs (id, kind, tenant_db, created_by, status, total, params, created_at, idempotency_key)
+                            VALUES (?, ?, ?, ?, 'running', ?, ?, ?, ?)""",
+                         (job.id, kind, tenant, user, job.total, json.dumps({**params, "workers": workers}),
+                          datetime.now().isoformat(), idempotency_key))
+        except sqlite3.IntegrityError:
+            # Otra petición con la misma clave ganó la carrera entre el SELECT y el INSERT
+            conn.rollback()
+            with bulk_jobs_lock:
+                bulk_jobs.pop(job.id, None)
+            return _idempotent_job(conn, idempotency_key)
+        conn.executemany("INSERT INTO bulk_job_items (job_id, serial) VALUES (?, ?)", [(job.id, s) for s in serials])
+        if resolved:
+            job.record(resolved)
+            _persist_outcomes(conn, job, resolved)
+        conn.commit()
+    return _launch(job, token, params, workers)
+
+def _idempotent_job(conn, idempotency_key):
+    """The job already created for a client idempotency key, or None"""
+    row = conn.execute("SELECT id FROM bulk_jobs WHERE idempotency_key = ?", (idempotency_key,)).fetchone()
+    return row and (bulk_jobs.get(row[0]) or _job_from_row(conn, row[0]))
+
+def _job_from_row(conn, job_id):
+    """Rebuild a BulkJob (counters included) from its persisted rows"""
+    r = conn.execute("SELECT kind, tenant_db, created_by, total, status FROM bulk_jobs WHERE id = ?", (job_id,)).fetchone()
+    counts = dict(conn.execute("""SELECT status = 'ok', COUNT(*) FROM bulk_job_items
+                                  WHERE job_id = ? AND status NOT IN ('pending', 'leased', 'cancelled') GROUP BY status = 'ok'""",
+                               (job_id,)).fetchall())
+    serials = [x[0] for x in conn.execute("SELECT serial FROM bulk_job_items WHERE job_id = ? ORDER BY rowid", (job_id,))]
+    job = BulkJob(job_id, r[0], r[1], r[2], serials, total=r[3], done=counts.get(1, 0), failed=counts.get(0, 0))
+    job.status = r[4]
+    return job
+
+def resume_bulk_job(job_id, token):
+    """Continue an interrupted job; only items not yet finished are processed"""
+    with db_pool.connection() as conn:
+        row = conn.execute("SELECT params FROM bulk_jobs WHERE id = ? AND status = 'interrupted'", (job_id,)).fetchone()
+        if not row or job_id in bulk_jobs and bulk_jobs[job_id].status == "running":
+            return None
+        job = _job_from_row(conn, job_id)
+        job.status = "running"
+        conn.execute("UPDATE bulk_jobs SET status = 'running', finished_at = NULL WHERE id = ?", (job_id,))
+        conn.commit()
+    params = json.loads(row[0] or "{}")
+    logging.info(f"Reanudando trabajo {job_id} ({job.kind}): {job.total - job.done - job.failed} pendientes")
+    return _launch(job, token, params, params.get("workers", BULK_WORKERS))
+
+def resume_interrupted_jobs(tenant, token, user):
+    """Resume the user's own jobs of the tenant that the last restart cut off. Other interrupted jobs
+    wait for an explicit POST /jobs/<id>/resume, so a login never runs someone else's job."""
+    with db_pool.connection() as conn:
+        ids = [r[0] for r in conn.execute("""SELECT id FROM bulk_jobs WHERE tenant_db = ? AND created_by = ?
+                                             AND status = 'interrupted'""", (tenant, user))
+               if r[0] in restart_interrupted]
+    restart_interrupted.difference_update(ids)
+    return [job.id for job in (resume_bulk_job(i, token) for i in ids) if job]
+
+def _job_row(conn, job_id):
+    r = conn.execute("""SELECT id, kind, tenant_db, status, total, done, failed, created_by, created_at, finished_at
+                        FROM bulk_jobs WHERE id = ?""", (job_id,)).fetchone()
+    if not r:
+        return None
+    return {"id": r[0], "kind": r[1], "tenant": r[2], "status": r[3], "total": r[4], "done": r[5], "failed": r[6],
+            "remaining": r[4] - r[5] - r[6], "created_by": r[7], "created_at": r[8], "finished_at": r[9]}
+
+def _job_items(conn, job_id, status=None):
+    sql, params = "SELECT serial, status, result, finished_at FROM bulk_job_items WHERE job_id = ?", [job_id]
+    if status:
+        sql += " AND status = ?"
+        params.append(status)
+    return [{"serial": r[0], "status": r[1], **(json.loads(r[2]) if r[2] else {}), "finished_at": r[3]}
+            for r in conn.execute(sql + " ORDER BY rowid", params)]
+
+def _job_response(job, data):
+    """202 with the job id, or the full per-device result when the client asked to wait"""
+    if not data.get('wait'):
+        return jsonify({"job_id": job.id, "status": job.status, "total": job.total}), 202
+    version = None
+    while job.status == "running":
+        version, _ = job.wait(version, JOB_EVENTS_KEEPALIVE)
+    return jsonify({**job.snapshot(), "results": _job_items(get_db(), job.id)})
+
+@app.route('/jobs', methods=['GET'])
+def list_jobs():
+    tenant = request.args.get('tenant') or request.cookies.get('tenant')
+    sql, params = "SELECT id FROM bulk_jobs WHERE tenant_db = ?", [tenant]
+    if request.args.get('status'):
+        sql += " AND status = ?"
+        params.append(request.args['status'])
+    conn = get_db()
+    ids = [r[0] for r in conn.execute(sql + " ORDER BY created_at DESC LIMIT 50", params)]
+    return jsonify([bulk_jobs[i].snapshot() if i in bulk_jobs else _job_row(conn, i) for i in ids])
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Job summary plus per-device results (?status=error to filter)"""
+    conn = get_db()
+    row = _job_row(conn, job_id)
+    if not row: return jsonify({"error": "Job not found"}), 404
+    summary = {**row, **bulk_jobs[job_id].snapshot()} if job_id in bulk_jobs else row
+    return jsonify({**summary, "results": _job_items(conn, job_id, request.args.get('status'))})
+
+@app.route('/jobs/<job_id>/trace', methods=['GET'])
+def job_trace(job_id):
+    """Where the job's time went, from its per-device spans: totals per phase and the slowest devices
+    (?slowest=N, by their own time, queue excluded). queue = waiting for a free worker, throttle = rate
+    limiter and retry pauses, upstream = Geotab calls, db = SQLite (each batch write shared among its
+    devices), local = everything else. bound_by is the largest phase other than queue."""
+    conn = get_db()
+    row = _job_row(conn, job_id)
+    if not row: return jsonify({"error": "Job not found"}), 404
+    try:
+        limit = min(int(request.args.get('slowest', TRACE_SLOWEST)), 1000)
+    except ValueError:
+        limit = 0
+    # LIMIT con un valor negativo devolvería todas las filas
+    if limit < 1:
+        return jsonify({"error": "slowest must be a whole number from 1 to 1000"}), 400
+    columns = [f"{phase}_ms" for phase in TRACE_PHASES]
+    own = " + ".join(columns[1:])
+    totals = conn.execute(f"""SELECT COUNT(*), COUNT(DISTINCT serial), COALESCE(SUM(retries), 0),
+                              {", ".join(f"SUM({c}), MAX({c})" for c in columns)} FROM bulk_spans WHERE job_id = ?""",
+                          (job_id,)).fetchone()
+    spans, grand = totals[0], sum(totals[3::2]) if totals[0] else 0
+    phases = {phase: {"total_seconds": round(totals[3 + 2 * i] / 1000, 3), "avg_ms": round(totals[3 + 2 * i] / spans, 2),
+                      "max_ms": totals[4 + 2 * i], "share": round(totals[3 + 2 * i] / grand, 3) if grand else 0}
+              for i, phase in enumerate(TRACE_PHASES)} if spans else {}
+    outcomes = dict(conn.execute("SELECT status, COUNT(*) FROM bulk_spans WHERE job_id = ? GROUP BY status", (job_id,)).fetchall())
+    slowest = conn.execute(f"""SELECT serial, attempt, {", ".join(columns)}, {own} AS device_ms, status, http_status, retries
+                               FROM bulk_spans WHERE job_id = ? ORDER BY device_ms DESC LIMIT ?""", (job_id, limit)).fetchall()
+    return jsonify({
+        "job_id": job_id, "kind": row["kind"], "status": row["status"], "spans": spans, "devices": totals[1],
+        "retries": totals[2], "outcomes": outcomes, "phases": phases,
+        "bound_by": max(TRACE_PHASES[1:], key=lambda p: phases[p]["total_seconds"]) if spans else None,
+        "slowest": [{"serial": r[0], "attempt": r[1], **dict(zip(columns, r[2:7])), "device_ms": round(r[7], 2),
+                     "status": r[8], "http_status": r[9], "retries": r[10]} for r in slowest],
+    })
+
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    """Server-Sent Events stream of job progress; ends with a 'done' event"""
+    job = bulk_jobs.get(job_id)
+    if job is None:
+        row = _job_row(get_db(), job_id)
+        if not row: return jsonify({"error": "Job not found"}), 404
+        body = iter([f"event: done\ndata: {json.dumps(row)}\n\n"])
+    else:
+        def stream():
+            version = None
+            while True:
+                version, snap = job.wait(version, JOB_EVENTS_KEEPALIVE)
+                finished = snap["status"] != "running"
+                yield f"event: {'done' if finished else 'progress'}\ndata: {json.dumps(snap)}\n\n"
+                if finished:
+                    return
+                time.sleep(JOB_EVENTS_INTERVAL)
+        body = stream()
+    response = Response(body, mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/jobs/<job_id>/resume', methods=['POST'])
+def resume_job(job_id):
+    """Resume an interrupted job with the session of the job's tenant; only a browser logged in to it may"""
+    row = get_db().execute("SELECT tenant_db FROM bulk_jobs WHERE id = ?", (job_id,)).fetchone()
+    if row and not _owns(row[0]): return jsonify({"error": "No session"}), 401
+    job = row and resume_bulk_job(job_id, token_store.get(row[0])[0])
+    if not job: return jsonify({"error": "Job not found or not interrupted"}), 409
+    return jsonify({"job_id": job.id, "status": job.status, "total": job.total, "remaining": job.total - job.done - job.failed}), 202
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    """Stop leasing new items; items already in flight finish normally"""
+    row = get_db().execute("SELECT tenant_db FROM bulk_jobs WHERE id = ?", (job_id,)).fetchone()
+    if row and not _owns(row[0]): return jsonify({"error": "No session"}), 401
+    job = bulk_jobs.get(job_id)
+    if job and job.status == "running":
+        job.cancelled = True
+        return jsonify({"job_id": job_id, "status": "cancelling"}), 202
+    conn = get_db()
+    cur = conn.execute("UPDATE bulk_jobs SET status = 'cancelled', finished_at = ? WHERE id = ? AND status = 'interrupted'",
+                       (datetime.now().isoformat(), job_id))
+    if not cur.rowcount: return jsonify({"error": "Job not found or already finished"}), 409
+    conn.execute("UPDATE bulk_job_items SET status = 'cancelled' WHERE job_id = ? AND status = 'pending'", (job_id,))
+    conn.commit()
+    return jsonify({"job_id": job_id, "status": "cancelled"})
+
+# ==================== BACKGROUND SYNC ====================
+
+class SyncScheduler:
+    """Keeps local key state fresh by re-syncing the stalest devices of each logged-in tenant,
+    at most SYNC_SCHED_BUDGET upstream requests per tenant every SYNC_SCHED_INTERVAL seconds"""
+
+    def __init__(self, interval=SYNC_SCHED_INTERVAL, budget=SYNC_SCHED_BUDGET, workers=SYNC_SCHED_WORKERS):
+        self.interval, self.budget, self.workers = interval, budget, workers
+        self._attempted = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.stats = {"runs": 0, "synced": 0, "changed": 0, "failed": 0, "last_run": None, "last_nightly": None}
+
+    def start(self):
+        if self.interval > 0 and self.budget > 0 and self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="sync-scheduler", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_nightly()
+                self.run_once()
+            except Exception:
+                logging.exception("Error en la sincronización en segundo plano")
+
+    def run_nightly(self, now=None):
+        """Once a day at NIGHTLY_SYNC_HOUR, a full sync job for every tenant with a session, all in parallel"""
+        now = now or datetime.now()
+        today = now.date().isoformat()
+        if NIGHTLY_SYNC_HOUR < 0 or now.hour != NIGHTLY_SYNC_HOUR or self.stats["last_nightly"] == today:
+            return {}
+        self.stats["last_nightly"] = today
+        jobs = sync_tenants(list(token_store.items()), {"idempotency_key": f"nightly:{today}"})
+        logging.info(f"Sincronización nocturna: {len(jobs)} tenants en paralelo")
+        return jobs
+
+    def candidates(self, conn, tenant, limit):
+        """Devices not synced within SYNC_STALE_SECONDS (a sixth of it for keys close to, not past, expiry):
+        half-open circuits first, then keys close to expiry, then oldest. Open circuits wait for retry_at."""
+        now = time.time()
+        cutoff = datetime.fromtimestamp(now - SYNC_STALE_SECONDS).isoformat()
+        expiring_cutoff = datetime.fromtimestamp(now - SYNC_STALE_SECONDS / 6).isoformat()
+        expiring = int((now + SYNC_EXPIRY_WINDOW_SECONDS) * 1000)
+        return [r[0] for r in conn.execute("""
+            SELECT serial_number FROM (
+                SELECT v.serial_number, v.faulty, v.last_synced_at, v.retry_at,
+                       EXISTS(SELECT 1 FROM virtual_keys k WHERE k.serial_number = v.serial_number
+                              AND k.tenant_db = v.tenant_db AND k.expires_at >= ? AND k.expires_at < ?) AS expiring
+                FROM vehicles v WHERE v.tenant_db = ?)
+            WHERE (last_synced_at IS NULL OR last_synced_at < ? OR faulty = 1 OR (expiring AND last_synced_at < ?))
+              AND (retry_at IS NULL OR retry_at <= ?)
+            ORDER BY faulty DESC, expiring DESC, last_synced_at IS NOT NULL, last_synced_at
+            LIMIT ?""", (int(now * 1000), expiring, tenant, cutoff, expiring_cutoff, datetime.fromtimestamp(now).isoformat(), limit))]
+
+    def run_once(self):
+        """One scheduling round over every tenant with a session, tenants in parallel; returns {tenant: devices synced}"""
+        sessions = token_store.items()
+        now = time.monotonic()
+        # Un dispositivo intentado hace poco (p.ej. faulty que sigue fallando) no vuelve a consumir presupuesto
+        with self._lock:
+            self._attempted = {k: t for k, t in self._attempted.items() if now - t < SYNC_STALE_SECONDS}
+        rounds = {}
+        for tenant, (token, user) in sessions.items():
+            if any(j.tenant == tenant and j.kind == "sync" and j.status == "running" for j in list(bulk_jobs.values())):
+                continue
+            with self._lock:
+                attempted = {s for t, s in self._attempted if t == tenant}
+            with db_pool.connection() as conn:
+                serials = [s for s in self.candidates(conn, tenant, self.budget + len(attempted))
+                           if s not in attempted][:self.budget]
+            if serials:
+                rounds[tenant] = (token, user, serials)
+        done = {}
+        if rounds:
+            with ThreadPoolExecutor(max_workers=len(rounds)) as pool:
+                futures = {tenant: pool.submit(self._sync, tenant, *args) for tenant, args in rounds.items()}
+                done = {tenant: f.result() for tenant, f in futures.items()}
+        with self._lock:
+            self.stats["runs"] += 1
+            self.stats["last_run"] = datetime.now().isoformat()
+        return done
+
+    def _sync(self, tenant, token, user, serials):
+        work, apply, _ = _sync_handlers(tenant, token, user, {})
+
+        def attempt(serial):
+            # Como en los trabajos masivos, un fallo es el resultado de ese dispositivo y no tumba la ronda
+            try:
+                return work(serial, 1)
+            except Exception as e:
+                logging.exception(f"Sincronización en segundo plano de {serial} ({tenant})")
+                return {"serial": serial, "status": "error", "error": str(e)[:200]}
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            outcomes = list(pool.map(attempt, serials))
+        if any(o.get("http_status") == 401 for o in outcomes):
+            # Token caducado: se renueva con las credenciales guardadas; si no se puede, el tenant sale de la rotación
+            if not token_store.refresh(tenant, token):
+                logging.info(f"Sesión caducada para {tenant}: se detiene la sincronización en segundo plano")
+            # Solo se descartan los 401 (se repiten con el token nuevo); el resto de resultados sí cuenta
+            outcomes = [o for o in outcomes if o.get("http_status") != 401]
+        now = time.monotonic()
+        with self._lock:
+            self._attempted.update(((tenant, o["serial"]), now) for o in outcomes)
+        with db_pool.connection() as conn:
+            apply(conn, outcomes)
+            conn.commit()
+        ok = [o for o in outcomes if o["status"] == "ok"]
+        with self._lock:
+            self.stats["synced"] += len(ok)
+            self.stats["changed"] += sum(1 for o in ok if o.get("changed"))
+            self.stats["failed"] += len(outcomes) - len(ok)
+        return len(ok)
+
+sync_scheduler = SyncScheduler()
+atexit.register(sync_scheduler.stop)
+
+@app.route('/sync-scheduler', methods=['GET'])
+def sync_scheduler_status():
+    """Background sync counters plus how many devices of the tenant are currently stale"""
+    tenant = request.args.get('tenant') or request.cookies.get('tenant')
+    cutoff = datetime.fromtimestamp(time.time() - SYNC_STALE_SECONDS).isoformat()
+    stale = get_db().execute("""SELECT COUNT(*) FROM vehicles WHERE tenant_db = ?
+                                 AND (last_synced_at IS NULL OR last_synced_at < ?)""", (tenant, cutoff)).fetchone()[0]
+    return jsonify({**sync_scheduler.stats, "enabled": sync_scheduler._thread is not None,
+                    "active": token_store.get(tenant)[0] is not None, "stale_devices": stale,
+                    "interval_seconds": sync_scheduler.interval, "budget": sync_scheduler.budget})
+
+# ==================== METRICS ENDPOINT ====================
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus text exposition: request, upstream and SQLite histograms plus gauges read at scrape time"""
+    with bulk_jobs_lock:
+        running = [j.snapshot() for j in bulk_jobs.values() if j.status == "running"]
+    jobs, throughput = {}, {}
+    for j in running:
+        jobs[(j["kind"],)] = jobs.get((j["kind"],), 0) + 1
+        throughput[(j["kind"],)] = throughput.get((j["kind"],), 0) + j["throughput"]
+    limits = geotab.limiter_stats()
+    gauges = [
+        ("keyless_audit_queue_depth", "Audit rows waiting for the background writer", (), {(): audit_writer.depth()}),
+        ("keyless_audit_backpressure_events", "Audit rows written synchronously because the queue was full", (),
+         {(): audit_writer.backpressure_events}),
+        ("keyless_bulk_jobs_running", "Bulk jobs currently running, by kind", ("kind",), jobs),
+        ("keyless_bulk_throughput_devices_per_second", "Combined devices/s of the running bulk jobs, by kind", ("kind",), throughput),
+        ("keyless_upstream_concurrency_limit", "Current adaptive concurrency limit per tenant", ("tenant",),
+         {(t,): l["concurrency_limit"] for t, l in limits.items()}),
+        ("keyless_upstream_in_flight", "Geotab calls in flight per tenant", ("tenant",), {(t,): l["in_flight"] for t, l in limits.items()}),
+        ("keyless_upstream_rate_limit", "Current token bucket rate (requests/s) per tenant", ("tenant",),
+         {(t,): l["rate"] for t, l in limits.items()}),
+    ]
+    return Response(metrics.render(gauges), mimetype="text/plain; version=0.0.4")
+
+# ==================== PROFILING ENDPOINTS ====================
+
+PROFILE_COLUMNS = "id, created_at, route, method, path, status, duration_ms, trigger, user, total_calls"
+
+def _admin_denied():
+    """403 response unless the request carries the admin token"""
+    if not ADMIN_TOKEN:
+        return jsonify({"error": "Profiling is disabled: set ADMIN_TOKEN"}), 403
+    if not _is_admin():
+        return jsonify({"error": "Admin token required"}), 403
+    return None
+
+def _profile_dict(row):
+    return dict(zip(PROFILE_COLUMNS.split(", "), row))
+
+@app.route('/profiles', methods=['GET', 'DELETE'])
+def list_profiles():
+    """Stored profiles, newest first; ?route= (rule, e.g. /vehicles), ?min_ms=, ?limit="""
+    denied = _admin_denied()
+    if denied: return denied
+    conn = get_db()
+    if request.method == 'DELETE':
+        deleted = conn.execute("DELETE FROM profiles").rowcount
+        conn.commit()
+        return jsonify({"deleted": deleted})
+    try:
+        limit = min(int(request.args.get('limit', 50)), 500)
+        min_ms = float(request.args.get('min_ms', 0))
+    except ValueError:
+        return jsonify({"error": "Invalid limit or min_ms"}), 400
+    sql, params = f"SELECT {PROFILE_COLUMNS} FROM profiles WHERE duration_ms >= ?", [min_ms]
+    if request.args.get('route'):
+        sql += " AND route = ?"
+        params.append(request.args['route'])
+    rows = conn.execute(sql + " ORDER BY created_at DESC LIMIT ?", params + [limit]).fetchall()
+    return jsonify([_profile_dict(r) for r in rows])
+
+@app.route('/profiles/<int:profile_id>', methods=['GET'])
+def get_profile(profile_id):
+    """One profile with its heaviest functions by own time ("self") and including callees ("cumulative")"""
+    denied = _admin_denied()
+    if denied: return denied
+    row = get_db().execute(f"SELECT {PROFILE_COLUMNS}, top_frames FROM profiles WHERE id = ?", (profile_id,)).fetchone()
+    if not row: return jsonify({"error": "Profile not found"}), 404
+    return jsonify({**_profile_dict(row[:-1]), "top": json.loads(row[-1])})
+
+@app.route('/profiles/<int:profile_id>/pstats', methods=['GET'])
+def download_profile(profile_id):
+    """Raw pstats file: python -m pstats, snakeviz or flameprof (flame graph) open it"""
+    denied = _admin_denied()
+    if denied: return denied
+    row = get_db().execute("SELECT stats FROM profiles WHERE id = ?", (profile_id,)).fetchone()
+    if not row: return jsonify({"error": "Profile not found"}), 404
+    response = Response(zlib.decompress(row[0]), mimetype='application/octet-stream')
+    response.headers['Content-Disposition'] = f'attachment; filename=profile_{profile_id}.prof'
+    return response
+
+@app.route('/profiles/config', methods=['GET', 'POST'])
+def profiles_config():
+    """Sampling settings; POST {"sample_rate": 0.05, "routes": ["/export-csv"], "min_ms": 500, "keep": 100}
+    applies immediately, until the next restart"""
+    denied = _admin_denied()
+    if denied: return denied
+    if request.method == 'POST':
+        try:
+            profiler.configure(request.get_json(silent=True) or {})
+        except (TypeError, ValueError) as e:
+            return jsonify({"error": str(e)}), 400
+        add_log(request.cookies.get('user_email'), "PROFILE_CONFIG", None, profiler.config())
+    return jsonify(profiler.config())
+
 if __name__ == '__main__':
     init_db()
+    sync_scheduler.start()
     Timer(1.5, lambda: webbrowser.open("http://127.0.0.1:5000")).start()
     app.run(debug=False, port=5000)
\ No newline at end of file
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""End-to-end bulk benchmark: drives the Flask bulk routes of app.py against the local fake Keyless API.
+
+    python bench/bench_bulk.py --devices 2000 --concurrency 16 --rate 200
+    python bench/bench_bulk.py --devices 500 --throttle-rps 30 --error-rate 0.02 --missing-rate 0.01
+
+For each flow (sync, create, delete) prints devices/s over the whole job and p50/p99 of the per-device
+work time, which includes upstream latency, limiter waits and retries. Uses a throw-away database."""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fake_keyless
+
+FLOWS = ("sync", "create", "delete")
+TENANT = "bench"
+
+def percentile(samples, p):
+    """Nearest-rank percentile"""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered))) - 1))]
+
+def timed_handlers(factory, samples):
+    """Wrap a BULK_HANDLERS factory so every work(serial, attempt) call is timed into `samples`"""
+    def wrapped(*args):
+        work, apply, on_finish = factory(*args)
+
+        def timed_work(serial, attempt):
+            start = time.perf_counter()
+            try:
+                return work(serial, attempt)
+            finally:
+                samples.append(time.perf_counter() - start)
+        return timed_work, apply, on_finish
+    return wrapped
+
+def run(args):
+    fake = fake_keyless.from_arguments(args)
+    os.environ["GEOTAB_BASE_URL"] = fake.start()
+    if args.rate:
+        os.environ["GEOTAB_RATE"], os.environ["GEOTAB_BURST"] = str(args.rate), str(max(1, int(args.rate)))
+    import app  # después de fijar el entorno: las constantes se leen al importar
+    app.logging.getLogger().setLevel(app.logging.WARNING)
+    workdir = tempfile.mkdtemp(prefix="keyless-bench-")
+    app.db_path = os.path.join(workdir, "vehicles.db")
+    app.init_db()
+
+    serials = [f"BENCH{i:06d}" for i in range(args.devices)]
+    with app.db_pool.connection() as conn:
+        conn.executemany("INSERT INTO vehicles (serial_number, description, tenant_db) VALUES (?, ?, ?)",
+                         [(s, "benchmark", TENANT) for s in serials])
+        conn.commit()
+    fake.seed_keys(TENANT, serials, per_device=1)
+
+    client = app.app.test_client()
+    res = client.post('/auth', json={"username": "bench", "password": "bench", "database": TENANT})
+    assert res.status_code == 200, res.get_data(as_text=True)
+
+    ending = int((time.time() + 30 * 86400) * 1000)
+    bodies = {
+        "sync": {"all": True},
+        "create": {"serials": serials, "vk": {"userReference": "bench", "endingTimestamp": ending}},
+        "delete": {"serials": serials},
+    }
+    print(f"{args.devices} devices, latency {args.latency}, concurrency {args.concurrency}, "
+          f"limiter {app.GEOTAB_RATE:g} req/s burst {app.GEOTAB_BURST}")
+    print(f"{'flow':<8}{'ok':>8}{'failed':>8}{'seconds':>10}{'devices/s':>12}{'p50 ms':>10}{'p99 ms':>10}")
+    results = {}
+    for flow in args.flows:
+        samples = []
+        original = app.BULK_HANDLERS[flow]
+        app.BULK_HANDLERS[flow] = timed_handlers(original, samples)
+        try:
+            start = time.perf_counter()
+            res = client.post(f'/{"sync-bulk" if flow == "sync" else flow + "-keys-bulk"}',
+                              json={**bodies[flow], "concurrency": args.concurrency, "wait": True})
+            elapsed = time.perf_counter() - start
+        finally:
+            app.BULK_HANDLERS[flow] = original
+        job = res.get_json()
+        results[flow] = {"ok": job["done"], "failed": job["failed"], "seconds": elapsed,
+                         "devices_per_s": args.devices / elapsed,
+                         "p50_ms": percentile(samples, 50) * 1000, "p99_ms": percentile(samples, 99) * 1000}
+        r = results[flow]
+        print(f"{flow:<8}{r['ok']:>8}{r['failed']:>8}{r['seconds']:>10.2f}{r['devices_per_s']:>12.1f}"
+              f"{r['p50_ms']:>10.1f}{r['p99_ms']:>10.1f}")
+
+    limits = app.geotab.limiter_stats().get(TENANT, {})
+    print(f"upstream: {fake.stats['requests']} requests {dict(sorted(fake.stats['by_status'].items()))}, "
+          f"limiter throttled {limits.get('throttled', 0)} retries {limits.get('retries', 0)} "
+          f"final concurrency {limits.get('concurrency_limit')}")
+    app.audit_writer.flush()
+    fake.stop()
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Bulk sync/create/delete throughput against the fake Keyless API")
+    parser.add_argument("--devices", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=8, help="Workers per bulk job (the app caps it)")
+    parser.add_argument("--rate", type=float, default=None, help="Override GEOTAB_RATE / GEOTAB_BURST for the run")
+    parser.add_argument("--flows", nargs="+", choices=FLOWS, default=list(FLOWS))
+    fake_keyless.add_arguments(parser)
+    run(parser.parse_args())
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+"""SQLite data-path micro-benchmarks through the Flask test client.
+
+    python bench/bench_db.py                      # 1k / 10k / 100k devices, compared with the baseline
+    python bench/bench_db.py --sizes 1000 10000 --save-baseline
+
+Synthetic databases (devices, 0-4 keys each, three audit rows per device, versioned templates) are
+generated once per size under the temp directory and reused. Every path is timed --repeat times; the
+fastest run (least disturbed by the machine) is compared with bench/db_baseline.json and paths slower
+than the tolerance are flagged (exit code 1); the median is reported alongside."""
+
+import argparse
+import csv
+import io
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app
+
+TENANT = "bench"
+# Cambiar al modificar el generador: las bases de datos en caché se regeneran
+GENERATOR_VERSION = "1"
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "db_baseline.json")
+CACHE_DIR = os.path.join(tempfile.gettempdir(), "keyless-bench-db")
+LOG_ACTIONS = ("SYNC", "CREATE_VK", "DELETE_VK", "SYNC_ERROR", "LOGIN")
+
+def _use_database(path):
+    """Point the app (and its connection pool) at another SQLite file"""
+    if path == app.db_path:
+        return
+    app.audit_writer.flush()
+    app.db_pool.close_all()
+    app.db_path = path
+
+def generate(path, devices, seed=42):
+    """Create a synthetic database for `devices` devices through the app's own schema migrations"""
+    rng = random.Random(seed)
+    _use_database(path)
+    app.db_pool.close_all()
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    app.init_db()
+    now = datetime.now()
+    now_ms = int(now.timestamp() * 1000)
+    serials = [f"SN{i:07d}" for i in range(devices)]
+    with app.db_pool.connection() as conn:
+        conn.executemany("INSERT INTO vehicles (serial_number, description, tenant_db, last_synced_at) VALUES (?, ?, ?, ?)",
+                         [(s, f"Unidad {rng.choice(('Norte', 'Sur', 'Este', 'Oeste'))} {i % 977}", TENANT,
+                           (now - timedelta(minutes=rng.randint(0, 20000))).isoformat()) for i, s in enumerate(serials)])
+        # 0-4 llaves por dispositivo (media ~1,5), caducidades entre hace 30 días y dentro de un año
+        conn.executemany("INSERT INTO virtual_keys (vk_id, serial_number, tenant_db, user_ref, expires_at) VALUES (?, ?, ?, ?, ?)",
+                         [(f"{s}-vk{k}", s, TENANT, f"driver{rng.randint(1, 5000)}",
+                           now_ms + rng.randint(-30, 365) * 86400000)
+                          for s in serials for k in range(rng.choice((0, 1, 1, 2, 2, 3, 4)))])
+        conn.executemany("INSERT INTO logs (timestamp, user, action, serial, parameters) VALUES (?, ?, ?, ?, ?)",
+                         [((now - timedelta(seconds=rng.randint(0, 90 * 86400))).isoformat(), "bench@example.com",
+                           rng.choice(LOG_ACTIONS), s, json.dumps({"keys_found": rng.randint(0, 4)}))
+                          for s in serials for _ in range(3)])
+        rows = []
+        for t in range(20):
+            previous = None
+            for version in (1, 2, 3):
+                template_id = f"tpl_bench{t:03d}v{version}"
+                rows.append((template_id, TENANT, f"Plantilla {t}", f"ref{t}", json.dumps({"permissions": ["Unlock", "Lock"]}),
+                             "[]", 12, version, previous, int(version == 3), now.isoformat(), "bench@example.com"))
+                previous = template_id
+        conn.executemany("""INSERT INTO vk_templates (id, tenant_db, name, user_ref, vk_config, nfc_tags, duration_months,
+                            version, previous_version_id, is_active, created_at, created_by) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                         rows)
+        conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('bench_generator', ?)", (GENERATOR_VERSION,))
+        conn.commit()
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        conn.execute("ANALYZE")
+    app.db_pool.close_all()
+
+def database_for(devices):
+    path = os.path.join(CACHE_DIR, f"vehicles_{devices}.db")
+    if os.path.exists(path):
+        _use_database(path)
+        with app.db_pool.connection() as conn:
+            row = conn.execute("SELECT value FROM settings WHERE key = 'bench_generator'").fetchone()
+        if row and row[0] == GENERATOR_VERSION:
+            return path
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    started = time.perf_counter()
+    generate(path, devices)
+    print(f"  generated {devices} devices in {time.perf_counter() - started:.1f}s ({path})")
+    return path
+
+def import_file(devices):
+    """CSV of devices/10 rows: half existing serials with a new description, half new devices"""
+    rows = max(10, devices // 10)
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(["serial", "description"])
+    for i in range(rows // 2):
+        writer.writerow([f"SN{i * 7 % devices:07d}", f"Renombrado {i}"])
+    for i in range(rows - rows // 2):
+        writer.writerow([f"NEW{i:07d}", f"Importado {i}"])
+    return out.getvalue().encode()
+
+def paths(devices):
+    """name -> (method, url, request kwargs factory or None, needs a fresh copy of the database)"""
+    csv_bytes = import_file(devices)
+    return {
+        "vehicles_full": ("GET", f"/vehicles?tenant={TENANT}", None, False),
+        "vehicles_page": ("GET", f"/vehicles?tenant={TENANT}&limit=200", None, False),
+        "vehicles_page_by_keys": ("GET", f"/vehicles?tenant={TENANT}&limit=200&sort=keys&order=desc", None, False),
+        "vehicles_search": ("GET", f"/vehicles/search?tenant={TENANT}&q=SN00", None, False),
+        "export_csv": ("GET", "/export-csv", None, False),
+        "export_csv_full": ("GET", "/export-csv?full=1", None, False),
+        "logs": ("GET", "/logs", None, False),
+        "logs_by_action": ("GET", "/logs?action=SYNC_ERROR", None, False),
+        "export_logs": ("GET", "/export-logs", None, False),
+        "keys_expiring": ("GET", f"/keys/expiring?tenant={TENANT}&within=7", None, False),
+        "templates": ("GET", f"/templates?tenant={TENANT}", None, False),
+        "template_get": ("GET", f"/templates/tpl_bench007v3?tenant={TENANT}", None, False),
+        "template_history": ("GET", f"/templates/tpl_bench007v3/history?tenant={TENANT}", None, False),
+        "import_csv": ("POST", "/import-csv",
+                       lambda: {"data": {"file": (io.BytesIO(csv_bytes), "import.csv")},
+                                "content_type": "multipart/form-data"}, True),
+    }
+
+def measure(devices, repeat, only=None):
+    source = database_for(devices)
+    client = app.app.test_client()
+    client.set_cookie('tenant', TENANT)
+    client.set_cookie('user_email', 'bench@example.com')
+    results = {}
+    for name, (method, url, kwargs, mutates) in paths(devices).items():
+        if only and name not in only:
+            continue
+        timings = []
+        for _ in range(repeat):
+            if mutates:
+                # Las rutas que escriben trabajan sobre una copia: cada repetición parte del mismo estado
+                copy = os.path.join(CACHE_DIR, f"scratch_{devices}.db")
+                _use_database(source)
+                shutil.copyfile(source, copy)
+                _use_database(copy)
+            else:
+                _use_database(source)
+            started = time.perf_counter()
+            res = client.open(url, method=method, **(kwargs() if kwargs else {}))
+            res.get_data()  # consume las respuestas en streaming
+            timings.append((time.perf_counter() - started) * 1000)
+            if res.status_code != 200:
+                raise RuntimeError(f"{name}: HTTP {res.status_code} {res.get_data(as_text=True)[:200]}")
+        results[name] = {"median_ms": round(statistics.median(timings), 2), "min_ms": round(min(timings), 2)}
+    _use_database(source)
+    return results
+
+def compare(results, baseline, tolerance, floor_ms):
+    """Paths whose fastest run is more than `tolerance` (fraction) and `floor_ms` slower than the baseline"""
+    regressions = []
+    for size, by_path in results.items():
+        for name, r in by_path.items():
+            base = baseline.get(str(size), {}).get(name)
+            if base and r["min_ms"] > base["min_ms"] * (1 + tolerance) and r["min_ms"] - base["min_ms"] > floor_ms:
+                regressions.append((size, name, base["min_ms"], r["min_ms"]))
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="SQLite data-path benchmarks at several fleet sizes")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--only", nargs="+", help="Run only these paths")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true", help="Write the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed slowdown before flagging (default 25%%)")
+    parser.add_argument("--floor-ms", type=float, default=2.0, help="Ignore differences smaller than this")
+    args = parser.parse_args()
+    app.logging.getLogger().setLevel(app.logging.WARNING)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    results = {}
+    for size in args.sizes:
+        print(f"{size} devices")
+        results[size] = measure(size, args.repeat, args.only)
+        for name, r in results[size].items():
+            base = baseline.get(str(size), {}).get(name)
+            delta = f"{(r['min_ms'] / base['min_ms'] - 1) * 100:+6.1f}%" if base and base["min_ms"] else ""
+            print(f"  {name:<24}{r['min_ms']:>10.2f} ms  (median {r['median_ms']:.2f}){'  ' + delta if delta else ''}")
+
+    if args.save_baseline:
+        for size, by_path in results.items():
+            baseline.setdefault(str(size), {}).update(by_path)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Baseline saved to {args.baseline}")
+        sys.exit(0)
+
+    regressions = compare(results, baseline, args.tolerance, args.floor_ms)
+    for size, name, before, after in regressions:
+        print(f"REGRESSION {size} devices {name}: {before:.2f} ms -> {after:.2f} ms")
+    sys.exit(1 if regressions else 0)
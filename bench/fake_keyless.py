@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+"""Local stand-in for the Geotab Keyless endpoints used by app.py, for load tests and benchmarks.
+
+    python bench/fake_keyless.py --port 8081 --latency lognormal:40,0.5 --throttle-rps 50
+    GEOTAB_BASE_URL=http://127.0.0.1:8081/api python app.py
+
+Endpoints: POST /api/auth and GET/POST/DELETE /api/tenants/<db>/devices/<serial>/virtual-keys[/<id>].
+Every device exists and starts empty unless seeded; a device holds at most 4 keys (400 after that)."""
+
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+MAX_KEYS_PER_DEVICE = 4
+DEVICE_PATH = re.compile(r"^/api/tenants/([^/]+)/devices/([^/]+)/virtual-keys(?:/([^/?]+))?(?:\?.*)?$")
+
+def parse_latency(spec):
+    """Latency distribution in milliseconds -> callable returning seconds.
+    const:40 | uniform:10,80 | normal:40,10 | lognormal:<median>,<sigma> | exp:<mean>"""
+    kind, _, args = spec.partition(":")
+    values = [float(x) for x in args.split(",") if x] if args else []
+    samplers = {
+        "const": lambda: values[0],
+        "uniform": lambda: random.uniform(values[0], values[1]),
+        "normal": lambda: random.gauss(values[0], values[1]),
+        "lognormal": lambda: values[0] * random.lognormvariate(0, values[1]),
+        "exp": lambda: random.expovariate(1 / values[0]),
+    }
+    if kind not in samplers:
+        raise ValueError(f"Unknown latency distribution: {spec}")
+    sampler = samplers[kind]
+    sampler()  # valida los argumentos
+    return lambda: max(sampler(), 0) / 1000
+
+class FakeKeyless:
+    """In-memory Keyless API. Faults are injected per request:
+    error_rate (500/503), throttle_rate (random 429), throttle_rps (per-tenant token bucket; 429 with
+    Retry-After when exceeded) and missing_rate (fraction of serials that answer 404, stable per serial)."""
+
+    def __init__(self, latency="const:0", error_rate=0.0, throttle_rate=0.0, throttle_rps=0.0,
+                 retry_after=1.0, missing_rate=0.0, seed=None):
+        self.latency = parse_latency(latency)
+        self.error_rate, self.throttle_rate, self.missing_rate = error_rate, throttle_rate, missing_rate
+        self.throttle_rps, self.retry_after = throttle_rps, retry_after
+        self.random = random.Random(seed)
+        self.keys = {}      # (tenant, serial) -> [vk]
+        self.tokens = set()
+        self.stats = {"requests": 0, "by_status": {}, "by_operation": {}}
+        self._buckets = {}  # tenant -> [tokens, updated_at]
+        self._lock = threading.Lock()
+        self._server = None
+
+    # ---------- estado ----------
+
+    def seed_keys(self, tenant, serials, per_device=1, expires_in_days=365):
+        """Give each device `per_device` keys, e.g. so a bulk sync or delete has something to do"""
+        ending = int((time.time() + expires_in_days * 86400) * 1000)
+        with self._lock:
+            for serial in serials:
+                self.keys[(tenant, serial)] = [{"virtualKeyId": uuid.uuid4().hex, "userReference": f"seed-{i}",
+                                                "endingTimestamp": ending} for i in range(per_device)]
+
+    def is_missing(self, serial):
+        digest = hashlib.sha1(serial.encode()).digest()
+        return int.from_bytes(digest[:4], "big") / 2 ** 32 < self.missing_rate
+
+    def _throttled(self, tenant):
+        """Token bucket per tenant; returns the seconds to wait, 0 when the request may pass"""
+        if self.throttle_rps <= 0:
+            return 0
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(tenant, (self.throttle_rps, now))
+        tokens = min(self.throttle_rps, tokens + (now - updated) * self.throttle_rps)
+        if tokens < 1:
+            self._buckets[tenant] = (tokens, now)
+            return (1 - tokens) / self.throttle_rps
+        self._buckets[tenant] = (tokens - 1, now)
+        return 0
+
+    # ---------- API ----------
+
+    def handle(self, method, path, headers, body):
+        """Returns (status, json body or None, extra headers)"""
+        time.sleep(self.latency())
+        if method == "POST" and path.split("?")[0] == "/api/auth":
+            if not body.get("username") or not body.get("database"):
+                return 401, {"error": "Invalid credentials"}, {}
+            token = uuid.uuid4().hex
+            with self._lock:
+                self.tokens.add(token)
+            return 200, {"accessToken": token}, {}
+
+        m = DEVICE_PATH.match(path)
+        if not m:
+            return 404, {"error": "Unknown endpoint"}, {}
+        tenant, serial, vk_id = m.groups()
+        auth = headers.get("Authorization", "")
+        with self._lock:
+            if auth[len("Bearer "):] not in self.tokens:
+                return 401, {"error": "Unauthorized"}, {}
+            wait = self._throttled(tenant)
+            roll = self.random.random()
+        if wait:
+            return 429, {"error": "Too many requests"}, {"Retry-After": f"{max(wait, 0.001):.3f}"}
+        if roll < self.throttle_rate:
+            return 429, {"error": "Too many requests"}, {"Retry-After": f"{self.retry_after:g}"}
+        if roll < self.throttle_rate + self.error_rate:
+            return self.random.choice((500, 503)), {"error": "Injected failure"}, {}
+        if self.is_missing(serial):
+            return 404, {"error": "Device not found"}, {}
+
+        with self._lock:
+            keys = self.keys.setdefault((tenant, serial), [])
+            if method == "GET" and not vk_id:
+                return 200, {"virtualKeys": list(keys)}, {}
+            if method == "POST" and not vk_id:
+                if len(keys) >= MAX_KEYS_PER_DEVICE:
+                    return 400, {"error": f"Device already has {MAX_KEYS_PER_DEVICE} virtual keys"}, {}
+                vk = {"virtualKeyId": uuid.uuid4().hex, "userReference": body.get("userReference"),
+                      "endingTimestamp": body.get("endingTimestamp")}
+                keys.append(vk)
+                return 200, vk, {}
+            if method == "DELETE" and vk_id:
+                if not any(k["virtualKeyId"] == vk_id for k in keys):
+                    return 404, {"error": "Virtual key not found"}, {}
+                keys[:] = [k for k in keys if k["virtualKeyId"] != vk_id]
+                return 204, None, {}
+        return 405, {"error": "Method not allowed"}, {}
+
+    def record(self, method, path, status):
+        operation = "auth" if path.startswith("/api/auth") else f"{method} virtual-keys"
+        with self._lock:
+            self.stats["requests"] += 1
+            self.stats["by_status"][status] = self.stats["by_status"].get(status, 0) + 1
+            self.stats["by_operation"][operation] = self.stats["by_operation"].get(operation, 0) + 1
+
+    # ---------- servidor ----------
+
+    def start(self, host="127.0.0.1", port=0):
+        """Serve in a background thread; returns the base URL for GEOTAB_BASE_URL"""
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def _serve(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                try:
+                    body = json.loads(self.rfile.read(length) or b"{}")
+                except ValueError:
+                    body = {}
+                status, payload, extra = fake.handle(self.command, self.path, self.headers, body)
+                fake.record(self.command, self.path, status)
+                data = json.dumps(payload).encode() if payload is not None else b""
+                self.send_response(status)
+                if payload is not None:
+                    self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in extra.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST = do_DELETE = _serve
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="fake-keyless", daemon=True).start()
+        return f"http://{host}:{self._server.server_address[1]}/api"
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+
+def add_arguments(parser):
+    parser.add_argument("--latency", default="lognormal:40,0.5",
+                        help="const:MS | uniform:LO,HI | normal:MEAN,SD | lognormal:MEDIAN,SIGMA | exp:MEAN (default lognormal:40,0.5)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of calls answering 500/503")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Fraction of calls answering 429")
+    parser.add_argument("--throttle-rps", type=float, default=0.0, help="Per-tenant requests/s before 429 (0 = unlimited)")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After seconds for --throttle-rate 429s")
+    parser.add_argument("--missing-rate", type=float, default=0.0, help="Fraction of devices answering 404")
+    parser.add_argument("--seed", type=int, default=None)
+
+def from_arguments(args):
+    return FakeKeyless(args.latency, args.error_rate, args.throttle_rate, args.throttle_rps,
+                       args.retry_after, args.missing_rate, args.seed)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    add_arguments(parser)
+    args = parser.parse_args()
+    fake = from_arguments(args)
+    print(f"Fake Keyless API on {fake.start(args.host, args.port)} (Ctrl+C to stop)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        fake.stop()
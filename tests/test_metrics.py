@@ -0,0 +1,34 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app
+
+
+class MetricsRenderTest(unittest.TestCase):
+    def test_render_mixes_http_status_and_error_labels(self):
+        metrics = app.Metrics()
+        metrics.counter("upstream_total", "Upstream calls", ("operation", "status"))
+        metrics.histogram("latency_seconds", "Latency", ("status",))
+        metrics.inc("upstream_total", "list_keys", 200)
+        metrics.inc("upstream_total", "list_keys", "error")
+        metrics.inc("upstream_total", "list_keys", 429)
+        metrics.observe("latency_seconds", 0.01, 200)
+        metrics.observe("latency_seconds", 0.02, "error")
+        text = metrics.render([("gauge", "A gauge", ("tenant",), {("a",): 1, ("b",): 2})])
+        self.assertIn('upstream_total{operation="list_keys",status="200"} 1', text)
+        self.assertIn('upstream_total{operation="list_keys",status="error"} 1', text)
+        self.assertIn('latency_seconds_count{status="error"} 1', text)
+
+    def test_metrics_endpoint_after_response_and_connection_error(self):
+        app.metrics.inc("keyless_upstream_responses_total", "auth", 200)
+        app.metrics.inc("keyless_upstream_responses_total", "auth", "error")
+        res = app.app.test_client().get('/metrics')
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('keyless_upstream_responses_total{operation="auth",status="error"}', res.get_data(as_text=True))
+
+
+if __name__ == '__main__':
+    unittest.main()